@@ -4,8 +4,22 @@
 Flask application for WhatsApp clone backend.
 """
 import os
+import threading
 import time
-from flask import Flask, request, jsonify
+from typing import Optional
+
+# Time each startup phase, starting before the heavier imports
+startup_mark = time.perf_counter()
+startup_phases = []
+
+def mark_startup_phase(name: str) -> None:
+    """Record how long a startup phase took since the previous mark"""
+    global startup_mark
+    now = time.perf_counter()
+    startup_phases.append((name, (now - startup_mark) * 1000))
+    startup_mark = now
+
+from flask import Flask, request, jsonify, session
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from dotenv import load_dotenv
@@ -15,44 +29,255 @@ load_dotenv()
 
 # Import our modules
 from db import get_storage
+from connection_registry import ConnectionRegistry
+from membership_cache import MembershipCache
+from typing_throttle import TypingThrottle
+from message_queue import get_socketio_options
+from password_hasher import PasswordHasher
+from starter_cache import StarterCache
+from openai_service import StarterGenerator
+from starter_prewarmer import StarterPrewarmer
+
+mark_startup_phase('imports')
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SESSION_SECRET', 'whatsapp-clone-secret')
 CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True)
 
-# Initialize SocketIO with CORS support
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Initialize SocketIO with CORS support, sharing broadcasts through a message queue if configured
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=os.getenv('SOCKETIO_ASYNC_MODE') or None,
+                    **get_socketio_options())
+mark_startup_phase('socketio')
+
+# Hash and verify passwords on a bounded process pool, forked before storage starts any threads
+password_hasher = PasswordHasher()
+password_hasher.start()
+mark_startup_phase('password pool')
 
 # Initialize storage
 storage = get_storage()
+mark_startup_phase('storage')
+
+# Track which users are connected on which sockets
+registry = ConnectionRegistry()
+
+# Cache membership checks for high-frequency socket events
+membership_cache = MembershipCache(storage)
+
+# Collapse typing indicator bursts per chat and user
+typing_throttle = TypingThrottle()
+
+# Generate conversation starters in the background, reusing results for an unchanged context
+starter_generator = StarterGenerator(cache=StarterCache())
+
+# Optionally precompute starters for chats that have gone quiet
+starter_prewarmer = StarterPrewarmer(storage, starter_generator) if os.getenv('STARTER_PREWARM') == 'true' else None
+
+# Set once a graceful shutdown starts so new sockets are turned away
+shutting_down = threading.Event()
+
+# Count the WSGI requests in flight, socket transports included, so shutdown can wait for them
+active_requests = 0
+active_requests_lock = threading.Lock()
+
+def track_requests(wsgi_app):
+    """Wrap a WSGI app to count the requests it is still handling"""
+    def tracked_wsgi_app(environ, start_response):
+        global active_requests
+        with active_requests_lock:
+            active_requests += 1
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            with active_requests_lock:
+                active_requests -= 1
+    return tracked_wsgi_app
+
+app.wsgi_app = track_requests(app.wsgi_app)
 
 # Import routes after initializing app, socketio, and storage
 from routes import register_routes
 
 # Register API routes
-register_routes(app, storage, socketio)
+register_routes(app, storage, socketio, registry, membership_cache, password_hasher, starter_generator,
+                starter_prewarmer)
+mark_startup_phase('routes')
+
+# Report the startup time breakdown
+startup_total = sum(duration for name, duration in startup_phases)
+print(f"Startup completed in {startup_total:.0f} ms (" + ", ".join(f"{name} {duration:.0f} ms" for name, duration in startup_phases) + ")")
+
+def get_acting_user_id(data) -> Optional[int]:
+    """Get the user a socket authenticated as, emitting an error instead when it
+    isn't authenticated or the event claims to come from someone else"""
+    user_id = registry.get_user_id(request.sid)
+    claimed_user_id = data.get('userId')
+    try:
+        claims_other_user = claimed_user_id is not None and int(claimed_user_id) != user_id
+    except (TypeError, ValueError):
+        claims_other_user = True
+    
+    if user_id is None or claims_other_user:
+        emit('error', {'message': 'Not authenticated as this user'})
+        return None
+    return user_id
+
+def is_chat_participant(chat_id: int, user_id: int) -> bool:
+    """Check chat membership, answering from the registry for authenticated sockets"""
+    if registry.is_member(request.sid, user_id, chat_id):
+        return True
+    
+    # The registry only knows this process's membership changes, so a miss is
+    # checked against storage, and a chat joined elsewhere is joined here too
+    if not membership_cache.is_chat_participant(chat_id, user_id):
+        return False
+    handle_membership_changed(chat_id, user_id, True)
+    return True
+
+def handle_membership_changed(chat_id: int, user_id: int, is_member: bool) -> None:
+    """Keep connected sockets' chat rooms in sync with chat membership"""
+    room = f"chat_{chat_id}"
+    if is_member:
+        for sid in registry.add_chat(user_id, chat_id):
+            socketio.server.enter_room(sid, room, namespace='/')
+    else:
+        for sid in registry.remove_chat(user_id, chat_id):
+            socketio.server.leave_room(sid, room, namespace='/')
+
+storage.add_membership_listener(handle_membership_changed)
+
+def emit_typing(chat_id: int, user_id: int, is_typing: bool, skip_sid=None) -> None:
+    """Broadcast a typing indicator transition to a chat"""
+    socketio.emit('typing', {
+        'userId': user_id,
+        'chatId': chat_id,
+        'isTyping': is_typing
+    }, room=f"chat_{chat_id}", skip_sid=skip_sid)
+
+def sweep_typing_indicators() -> None:
+    """Background task releasing throttled and expired typing transitions"""
+    while not shutting_down.is_set():
+        socketio.sleep(typing_throttle.interval / 2)
+        for chat_id, user_id, is_typing in typing_throttle.flush_due():
+            emit_typing(chat_id, user_id, is_typing, skip_sid=registry.get_sids(user_id) or None)
+
+socketio.start_background_task(sweep_typing_indicators)
+
+def prewarm_conversation_starters() -> None:
+    """Background task pre-warming starters for chats whose quiet period has passed"""
+    while not shutting_down.is_set():
+        socketio.sleep(min(starter_prewarmer.quiet_period / 2, 1))
+        starter_prewarmer.run_due()
+
+if starter_prewarmer:
+    socketio.start_background_task(prewarm_conversation_starters)
+
+def drain_connections(timeout: float) -> bool:
+    """Disconnect all sockets once their queued emits are sent, returning False on timeout"""
+    shutting_down.set()
+    
+    # Stop any typing indicators before their sockets go away
+    for chat_id, user_id, is_typing in typing_throttle.flush_due(float('inf')):
+        emit_typing(chat_id, user_id, is_typing)
+    
+    # Close every socket without blocking, then wait until only the close marker is left queued
+    eio = socketio.server.eio
+    sockets = list(eio.sockets.items())
+    for eio_sid, eio_socket in sockets:
+        eio_socket.close(wait=False)
+    
+    deadline = time.monotonic() + timeout
+    pending = sockets
+    while pending and time.monotonic() < deadline:
+        socketio.sleep(0.05)
+        pending = [(eio_sid, eio_socket) for eio_sid, eio_socket in pending if eio_socket.queue.qsize() > 1]
+    
+    for eio_sid, eio_socket in sockets:
+        eio.sockets.pop(eio_sid, None)
+    return not pending
+
+def wait_for_requests(timeout: float) -> bool:
+    """Wait for in-flight requests to finish, returning False on timeout"""
+    deadline = time.monotonic() + timeout
+    while active_requests and time.monotonic() < deadline:
+        socketio.sleep(0.05)
+    return not active_requests
+
+def stop_serving(timeout: float = 10) -> None:
+    """Drain connected sockets and in-flight requests once the server stops accepting"""
+    print("Shutting down: draining connections")
+    if not drain_connections(timeout):
+        print(f"Connections still open after {timeout}s, closing anyway")
+    
+    print("Shutting down: waiting for in-flight requests")
+    if not wait_for_requests(timeout):
+        print(f"Requests still running after {timeout}s, closing anyway")
+
+def close_resources() -> None:
+    """Stop the worker pools and flush storage once no request can use them"""
+    print("Shutting down: flushing storage")
+    password_hasher.close()
+    starter_generator.close()
+    storage.close()
+
+def broadcast_user_status(user_id: int, is_online: bool, chat_ids) -> None:
+    """Notify a user's chats that they came online or went offline"""
+    for chat_id in chat_ids:
+        emit('user_status', {
+            'userId': user_id,
+            'isOnline': is_online,
+            'timestamp': round(time.time() * 1000)
+        }, room=f"chat_{chat_id}", skip_sid=request.sid)
 
 # SocketIO event handlers
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
     print(f"Client connected: {request.sid}")
+    
+    # Turn away new sockets while shutting down so clients reconnect elsewhere
+    if shutting_down.is_set():
+        return False
+    
+    # Authenticate the socket from the Flask session
+    user_id = session.get('user_id')
+    if not user_id:
+        return
+    
+    # Join the user's own room and all of their chat rooms
+    chat_ids = storage.get_chat_ids_by_user_id(user_id)
+    first_connection = registry.register(request.sid, user_id, chat_ids)
+    join_room(f"user_{user_id}")
+    for chat_id in chat_ids:
+        join_room(f"chat_{chat_id}")
+    
+    # Announce presence when the user's first socket connects
+    if first_connection:
+        storage.update_user_status(user_id, True)
+        broadcast_user_status(user_id, True, chat_ids)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
     print(f"Client disconnected: {request.sid}")
+    
+    # Announce the user went offline when their last socket disconnects
+    chat_ids = registry.get_chat_ids(registry.get_user_id(request.sid))
+    user_id, last_connection = registry.unregister(request.sid)
+    if user_id and last_connection:
+        storage.update_user_status(user_id, False)
+        broadcast_user_status(user_id, False, chat_ids)
 
 @socketio.on('join')
 def handle_join(data):
     """Join a chat room"""
-    user_id = data.get('userId')
+    user_id = get_acting_user_id(data)
     chat_id = data.get('chatId')
     
     if user_id and chat_id:
         # Verify user is a participant in this chat
-        if storage.is_chat_participant(chat_id, user_id):
+        if is_chat_participant(chat_id, user_id):
             room = f"chat_{chat_id}"
             join_room(room)
             print(f"User {user_id} joined room {room}")
@@ -69,7 +294,7 @@ def handle_join(data):
 @socketio.on('leave')
 def handle_leave(data):
     """Leave a chat room"""
-    user_id = data.get('userId')
+    user_id = get_acting_user_id(data)
     chat_id = data.get('chatId')
     
     if user_id and chat_id:
@@ -87,94 +312,103 @@ def handle_leave(data):
 @socketio.on('message')
 def handle_message(data):
     """Handle new message"""
-    user_id = data.get('userId')
+    user_id = get_acting_user_id(data)
     chat_id = data.get('chatId')
     content = data.get('content')
     
     if user_id and chat_id and content:
         # Verify user is a participant in this chat
-        if storage.is_chat_participant(chat_id, user_id):
-            # Create new message
-            message = storage.create_message({
+        if is_chat_participant(chat_id, user_id):
+            # Create new message with statuses for all participants in one write
+            participant_ids = storage.get_chat_participant_ids(chat_id)
+            message = storage.create_message_with_statuses({
                 'chatId': chat_id,
                 'senderId': user_id,
                 'content': content,
                 'timestamp': round(time.time() * 1000),
                 'status': 'sent'
-            })
-            
-            # Create message status for sender
-            storage.create_message_status({
-                'messageId': message['id'],
-                'userId': user_id,
-                'status': 'sent',
-                'timestamp': round(time.time() * 1000)
-            })
-            
-            # Get all chat participants
-            participants = storage.get_chat_participants(chat_id)
-            
-            # Create message status for other participants
-            for participant in participants:
-                if participant['userId'] != user_id:
-                    storage.create_message_status({
-                        'messageId': message['id'],
-                        'userId': participant['userId'],
-                        'status': 'delivered',
-                        'timestamp': round(time.time() * 1000)
-                    })
+            }, participant_ids)
             
             # Broadcast message to room
             room = f"chat_{chat_id}"
             emit('message', message, room=room)
+            
+            # Precompute conversation starters once the chat goes quiet
+            if starter_prewarmer:
+                starter_prewarmer.schedule(chat_id)
         else:
             emit('error', {'message': 'Not authorized to send messages to this chat'})
 
 @socketio.on('typing')
 def handle_typing(data):
     """Handle typing indicator"""
-    user_id = data.get('userId')
+    user_id = get_acting_user_id(data)
     chat_id = data.get('chatId')
     is_typing = data.get('isTyping', False)
     
     if user_id and chat_id:
         # Verify user is a participant in this chat
-        if storage.is_chat_participant(chat_id, user_id):
-            room = f"chat_{chat_id}"
-            emit('typing', {
-                'userId': user_id,
-                'chatId': chat_id,
-                'isTyping': is_typing
-            }, room=room, skip_sid=request.sid)
+        if is_chat_participant(chat_id, user_id):
+            # Only broadcast start/stop transitions the throttle lets through
+            state = typing_throttle.update(chat_id, user_id, bool(is_typing))
+            if state is not None:
+                emit_typing(chat_id, user_id, state, skip_sid=request.sid)
 
 @socketio.on('read')
 def handle_read(data):
     """Handle message read receipts"""
-    user_id = data.get('userId')
+    user_id = get_acting_user_id(data)
     message_id = data.get('messageId')
     
     if user_id and message_id:
         # Update message status to read
-        message_status = storage.update_message_status(message_id, user_id, 'read')
+        try:
+            message_status = storage.update_message_status(message_id, user_id, 'read')
+        except ValueError as e:
+            emit('error', {'message': str(e)})
+            return
         
         if message_status:
-            # Get the message from chat messages
-            chat_messages = []
-            for chat_id_str in range(1, 100):  # Attempt to get messages from chats with IDs 1-99
-                try:
-                    chat_messages.extend(storage.get_messages_by_chat_id(chat_id_str))
-                except:
-                    pass
-            message = next((m for m in chat_messages if m['id'] == message_id), None)
+            # Look up the acknowledged message directly by ID
+            message = storage.get_message(message_id)
             
             if message:
-                # Notify sender
+                # Notify sender, echoing the ID as storage coerced it
                 emit('message_read', {
-                    'messageId': message_id,
+                    'messageId': message_status['messageId'],
                     'userId': user_id,
                     'timestamp': round(time.time() * 1000)
                 }, room=f"user_{message['senderId']}")
 
+@socketio.on('read_up_to')
+def handle_read_up_to(data):
+    """Handle a batched read receipt for all messages in a chat up to a point"""
+    user_id = get_acting_user_id(data)
+    chat_id = data.get('chatId')
+    message_id = data.get('messageId')
+    timestamp = data.get('timestamp')
+    
+    if user_id and chat_id and (message_id or timestamp):
+        # Verify user is a participant in this chat
+        if not is_chat_participant(chat_id, user_id):
+            emit('error', {'message': 'Not authorized to read this chat'})
+            return
+        
+        try:
+            read_message_ids = storage.mark_messages_read_up_to(chat_id, user_id, message_id=message_id, timestamp=timestamp)
+        except ValueError as e:
+            emit('error', {'message': str(e)})
+            return
+        
+        if read_message_ids:
+            # Notify the chat once for the whole batch
+            emit('message_read', {
+                'chatId': chat_id,
+                'userId': user_id,
+                'messageIds': read_message_ids,
+                'timestamp': round(time.time() * 1000)
+            }, room=f"chat_{chat_id}", skip_sid=request.sid)
+
 if __name__ == '__main__':
     # For development only - in production, use a proper WSGI server
     port = int(os.getenv('PORT', 5001))
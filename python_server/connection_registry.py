@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Registry of connected Socket.IO sessions for the WhatsApp clone application."""
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+class ConnectionRegistry:
+    """Tracks which sockets belong to which users and which chats those users are in"""
+    
+    def __init__(self):
+        """Initialize an empty registry"""
+        self._lock = threading.Lock()
+        self._user_ids_by_sid: Dict[str, int] = {}
+        self._sids_by_user: Dict[int, Set[str]] = {}
+        self._chat_ids_by_user: Dict[int, Set[int]] = {}
+    
+    def register(self, sid: str, user_id: int, chat_ids: List[int]) -> bool:
+        """Register an authenticated socket, returning True if it is the user's first"""
+        with self._lock:
+            self._user_ids_by_sid[sid] = user_id
+            sids = self._sids_by_user.setdefault(user_id, set())
+            sids.add(sid)
+            self._chat_ids_by_user[user_id] = set(chat_ids)
+            return len(sids) == 1
+    
+    def unregister(self, sid: str) -> Tuple[Optional[int], bool]:
+        """Remove a socket, returning its user and whether it was the user's last"""
+        with self._lock:
+            user_id = self._user_ids_by_sid.pop(sid, None)
+            if user_id is None:
+                return None, False
+            
+            sids = self._sids_by_user.get(user_id, set())
+            sids.discard(sid)
+            if sids:
+                return user_id, False
+            
+            # Forget the user once their last socket is gone
+            self._sids_by_user.pop(user_id, None)
+            self._chat_ids_by_user.pop(user_id, None)
+            return user_id, True
+    
+    def get_user_id(self, sid: str) -> Optional[int]:
+        """Get the user an authenticated socket belongs to"""
+        return self._user_ids_by_sid.get(sid)
+    
+    def get_sids(self, user_id: int) -> List[str]:
+        """Get the active sockets of a user"""
+        with self._lock:
+            return list(self._sids_by_user.get(user_id, ()))
+    
+    def get_chat_ids(self, user_id: int) -> List[int]:
+        """Get the chats of a connected user"""
+        with self._lock:
+            return list(self._chat_ids_by_user.get(user_id, ()))
+    
+    def is_online(self, user_id: int) -> bool:
+        """Check if a user has any active socket"""
+        return user_id in self._sids_by_user
+    
+    def add_chat(self, user_id: int, chat_id: int) -> List[str]:
+        """Record that a connected user joined a chat, returning the user's sockets"""
+        with self._lock:
+            if user_id not in self._sids_by_user:
+                return []
+            self._chat_ids_by_user[user_id].add(chat_id)
+            return list(self._sids_by_user[user_id])
+    
+    def remove_chat(self, user_id: int, chat_id: int) -> List[str]:
+        """Record that a connected user left a chat, returning the user's sockets"""
+        with self._lock:
+            if user_id not in self._sids_by_user:
+                return []
+            self._chat_ids_by_user[user_id].discard(chat_id)
+            return list(self._sids_by_user[user_id])
+    
+    def is_member(self, sid: str, user_id: int, chat_id: int) -> bool:
+        """Check if the registry knows an authenticated socket's own user is in a chat.
+        
+        Only membership changes made in this process reach the registry, so
+        False is not authoritative: the chat may have been created or joined
+        through another worker, and callers fall back to storage.
+        """
+        if self._user_ids_by_sid.get(sid) != user_id:
+            return False
+        return chat_id in self._chat_ids_by_user.get(user_id, ())
\ No newline at end of file
@@ -3,17 +3,98 @@
 import os
 import json
 import time
+import bisect
+import functools
+import shutil
+import tempfile
+import threading
 import bcrypt
-from typing import Dict, List, Any, Optional, Union
-from pymongo import MongoClient
+from typing import Dict, List, Any, Optional, Union, Callable, Iterable
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
+from message_segments import SegmentedMessageStore
+from records import ChatParticipant, Message, MessageStatus
+from status_store import STATUS_CODES, MessageStatusStore
 
 # Load environment variables
 load_dotenv()
 
+# Page size limits for paginated message history
+DEFAULT_MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+
+# MongoDB projections hiding internal and sensitive fields
+USER_PROJECTION = {'_id': 0, 'password': 0}
+STATUS_PROJECTION = {'_id': 0, 'chatId': 0, 'senderId': 0}
+
+# Seeding of empty stores: 'fixture' loads precomputed demo data, 'demo' builds
+# it with live bcrypt hashing, 'none' leaves the store empty
+SEED_MODES = ('fixture', 'demo', 'none')
+DEMO_FIXTURE_FILE = os.path.join(os.path.dirname(__file__), 'fixtures', 'demo_data.json')
+
+# When InMemoryStorage writes mutations to disk: 'always' before each write
+# returns, 'interval' every STORAGE_FLUSH_INTERVAL_MS, 'count' once
+# STORAGE_FLUSH_MUTATIONS mutations are pending or the oldest of them has
+# waited STORAGE_FLUSH_MAX_AGE_MS
+DURABILITY_POLICIES = ('always', 'interval', 'count')
+
+def load_demo_fixture(path: str = DEMO_FIXTURE_FILE) -> Dict[str, Any]:
+    """Load precomputed demo data, stamping its records with the current time"""
+    with open(path, 'r', encoding='utf-8') as f:
+        fixture = json.load(f)
+    
+    now = int(time.time() * 1000)
+    for collection, records in fixture.items():
+        if collection == 'counters':
+            continue
+        for record in records.values():
+            for field in ('createdAt', 'updatedAt', 'lastSeen'):
+                if field in record:
+                    record[field] = now
+    
+    return fixture
+
+def to_id(value: Any, name: str = 'ID') -> int:
+    """Coerce an ID from a client payload to int, raising ValueError if it isn't one"""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"Invalid {name}: {value!r}")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name}: {value!r}") from None
+
 class Storage:
     """Base Storage Interface"""
     
+    def __init__(self):
+        """Initialize shared storage state"""
+        self._membership_listeners = []
+    
+    def add_membership_listener(self, listener: Callable[[int, int, bool], None]) -> None:
+        """Register a callback invoked with (chat_id, user_id, is_member) when chat membership changes"""
+        self._membership_listeners.append(listener)
+    
+    def _notify_membership_changed(self, chat_id: int, user_id: int, is_member: bool) -> None:
+        """Notify membership listeners of a participant being added or removed"""
+        for listener in self._membership_listeners:
+            listener(chat_id, user_id, is_member)
+    
+    def _get_seed_mode(self) -> str:
+        """Get how an empty store is seeded"""
+        seed_mode = os.getenv('STORAGE_SEED_MODE', 'fixture')
+        if seed_mode not in SEED_MODES:
+            raise ValueError(f"Unknown storage seed mode '{seed_mode}'")
+        return seed_mode
+    
+    def flush(self) -> None:
+        """Make all completed writes durable"""
+        pass
+    
+    def close(self) -> None:
+        """Flush pending writes and release storage resources"""
+        self.flush()
+    
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
         raise NotImplementedError
@@ -34,6 +115,10 @@ class Storage:
         """Update user online status"""
         raise NotImplementedError
     
+    def update_user_password(self, user_id: int, password_hash: str) -> None:
+        """Replace a user's password hash"""
+        raise NotImplementedError
+    
     def get_contacts_by_user_id(self, user_id: int) -> List[Dict[str, Any]]:
         """Get contacts for user"""
         raise NotImplementedError
@@ -50,10 +135,18 @@ class Storage:
         """Get chats for user"""
         raise NotImplementedError
     
+    def get_chat_ids_by_user_id(self, user_id: int) -> List[int]:
+        """Get the IDs of the chats a user participates in"""
+        raise NotImplementedError
+    
     def get_chat_by_id(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
         """Get chat by ID"""
         raise NotImplementedError
     
+    def get_direct_chat_ids(self, user_id: int, contact_ids: List[int]) -> Dict[int, int]:
+        """Get the IDs of the two-person chats between a user and each of the given contacts, keyed by contact"""
+        raise NotImplementedError
+    
     def get_chat_by_participants(self, participant_ids: List[int]) -> Optional[Dict[str, Any]]:
         """Get chat by participant IDs"""
         raise NotImplementedError
@@ -70,18 +163,51 @@ class Storage:
         """Add participant to chat"""
         raise NotImplementedError
     
+    def remove_chat_participant(self, chat_id: int, user_id: int) -> None:
+        """Remove participant from chat"""
+        raise NotImplementedError
+    
     def is_chat_participant(self, chat_id: int, user_id: int) -> bool:
         """Check if user is participant in chat"""
         raise NotImplementedError
     
+    def get_chat_participant_ids(self, chat_id: int) -> List[int]:
+        """Get the user IDs of a chat's participants"""
+        raise NotImplementedError
+    
     def get_messages_by_chat_id(self, chat_id: int) -> List[Dict[str, Any]]:
         """Get messages for chat"""
         raise NotImplementedError
     
+    def get_messages_page(self, chat_id: int, before: Optional[int] = None, after: Optional[int] = None,
+                          limit: int = DEFAULT_MESSAGE_PAGE_SIZE) -> Dict[str, Any]:
+        """Get a page of chat messages before or after a cursor message ID.
+        
+        Without a cursor the latest messages are returned. Messages are always
+        ordered oldest first; 'nextCursor' is the message ID to pass as the same
+        cursor to continue paging, or None when there are no more messages.
+        """
+        raise NotImplementedError
+    
+    def get_recent_messages_by_chat_ids(self, chat_ids: List[int], limit: int = 5) -> Dict[int, List[Dict[str, Any]]]:
+        """Get the latest messages of several chats, oldest first, keyed by chat"""
+        raise NotImplementedError
+    
+    def get_message(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """Get message by ID, raising ValueError for an ID that isn't an integer"""
+        raise NotImplementedError
+    
     def create_message(self, message_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create new message"""
         raise NotImplementedError
     
+    def create_message_with_statuses(self, message_data: Dict[str, Any], participant_ids: List[int]) -> Dict[str, Any]:
+        """Create a message and its statuses for all participants in one batch.
+        
+        The sender's status is 'sent' and every other participant's is 'delivered'.
+        """
+        raise NotImplementedError
+    
     def get_message_status_by_message_and_user_id(self, message_id: int, user_id: int) -> Optional[Dict[str, Any]]:
         """Get message status by message ID and user ID"""
         raise NotImplementedError
@@ -90,22 +216,89 @@ class Storage:
         """Create message status"""
         raise NotImplementedError
     
-    def update_message_status(self, message_id: int, user_id: int, status: str) -> Dict[str, Any]:
-        """Update message status"""
+    def update_message_status(self, message_id: int, user_id: int, status: str) -> Optional[Dict[str, Any]]:
+        """Update message status, returning None for an unknown status name and
+        raising ValueError for a malformed ID or a missing status"""
+        raise NotImplementedError
+    
+    def mark_messages_read_up_to(self, chat_id: int, user_id: int, message_id: Optional[int] = None,
+                                 timestamp: Optional[int] = None) -> List[int]:
+        """Mark a user's unread messages in a chat as read in one batch.
+        
+        Messages up to and including the given message ID, or with a timestamp
+        at or before the given timestamp, are marked. The user's own messages
+        are skipped. Returns the IDs of the messages that were marked read.
+        """
         raise NotImplementedError
 
+def _mutation(method: Callable) -> Callable:
+    """Run an InMemoryStorage mutation under the storage lock, writing it out
+    under the 'always' durability policy once the outermost mutation is done"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        outermost = False
+        try:
+            with self._lock:
+                self._mutation_depth += 1
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    self._mutation_depth -= 1
+                    outermost = not self._mutation_depth
+        finally:
+            # Write outside the lock, so concurrent writers can share one write
+            if outermost and self.durability == 'always':
+                self._write_pending()
+    
+    return wrapper
+
 class InMemoryStorage(Storage):
     """In-memory storage for development and testing"""
     
-    def __init__(self):
+    # Persisted collections, mapped to the counter that allocates their IDs
+    COLLECTION_COUNTERS = {
+        'users': 'user_id_counter',
+        'contacts': 'contact_id_counter',
+        'chats': 'chat_id_counter',
+        'chat_participants': 'chat_participant_id_counter',
+        'messages': 'message_id_counter',
+        'message_statuses': 'message_status_id_counter',
+    }
+    
+    # Collections held as slotted records keyed by int ID, converted to dicts
+    # only when returned from the API or written to disk
+    RECORD_TYPES = {
+        'chat_participants': ChatParticipant,
+        'messages': Message,
+        'message_statuses': MessageStatus,
+    }
+    
+    def __init__(self, persistence_mode: Optional[str] = None, durability: Optional[str] = None):
         """Initialize in-memory storage"""
+        super().__init__()
+        
+        # Mutations hold the storage lock, and snapshots are captured under it
+        self._lock = threading.RLock()
+        self._mutation_depth = 0
+        
         # Define data structures
         self.users = {}
         self.contacts = {}
         self.chats = {}
-        self.chat_participants = {}
-        self.messages = {}
-        self.message_statuses = {}
+        self.chat_participants = {}  # participant ID -> ChatParticipant
+        self.message_statuses = MessageStatusStore()  # status ID -> MessageStatus, stored in columns
+        
+        # Secondary indexes, rebuilt on load and kept in sync on every write
+        self._user_ids_by_username = {}  # username -> user key
+        self._contact_ids_by_user = {}  # userId -> {contactId: contact key}
+        self._participant_ids_by_chat = {}  # chatId -> {userId: participant ID}
+        self._chat_ids_by_user = {}  # userId -> [chatId, ...]
+        self._memberships = set()  # {(chatId, userId), ...}
+        self._message_ids_by_chat = {}  # chatId -> [messageId, ...] ordered by timestamp
+        
+        # Chat list aggregates, maintained incrementally alongside the indexes
+        self._latest_message_ids = {}  # chatId -> latest messageId
+        self._unread_counts = {}  # (chatId, userId) -> unread message count
         
         # Define counters
         self.user_id_counter = 0
@@ -124,24 +317,89 @@ class InMemoryStorage(Storage):
             'contacts': os.path.join(self.storage_dir, 'contacts.json'),
             'chats': os.path.join(self.storage_dir, 'chats.json'),
             'chat_participants': os.path.join(self.storage_dir, 'chat_participants.json'),
-            'messages': os.path.join(self.storage_dir, 'messages.json'),
+            'messages': os.path.join(self.storage_dir, 'messages'),
             'message_statuses': os.path.join(self.storage_dir, 'message_statuses.json'),
             'counters': os.path.join(self.storage_dir, 'counters.json'),
         }
         
+        # Messages are kept in segment files loaded on demand, replacing the
+        # single messages.json file of older data directories
+        self.legacy_messages_file = os.path.join(self.storage_dir, 'messages.json')
+        self.messages = SegmentedMessageStore(self.storage_files['messages'])
+        
+        # Persistence mode: 'snapshot' rewrites the JSON files on every mutation,
+        # 'wal' appends each mutation to a write-ahead log that is periodically
+        # compacted into the JSON snapshot files
+        self.persistence_mode = persistence_mode or os.getenv('STORAGE_PERSISTENCE', 'snapshot')
+        if self.persistence_mode not in ('snapshot', 'wal'):
+            raise ValueError(f"Unknown storage persistence mode '{self.persistence_mode}'")
+        
+        # Write-ahead log settings
+        self.log_file = os.path.join(self.storage_dir, 'wal.log')
+        self.compacting_log_file = os.path.join(self.storage_dir, 'wal.log.old')
+        self.snapshot_interval = float(os.getenv('STORAGE_SNAPSHOT_INTERVAL', 60))
+        self.max_log_bytes = int(os.getenv('STORAGE_WAL_MAX_BYTES', 4 * 1024 * 1024))
+        self._log = None
+        self._log_bytes = 0
+        self._log_lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_requested = threading.Event()
+        self._closed = threading.Event()
+        self._snapshot_thread = None
+        self._persistence_suspended = False
+        
+        # Durability policy: buffered mutations from many requests are coalesced
+        # by a background flusher into one fsynced write. Snapshot files are
+        # always synced before they replace the old ones; syncing every single
+        # log append under 'always' is opt-in with STORAGE_FSYNC=true
+        self.durability = durability or os.getenv('STORAGE_DURABILITY', 'always')
+        if self.durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown storage durability policy '{self.durability}'")
+        self.flush_interval = float(os.getenv('STORAGE_FLUSH_INTERVAL_MS', 100)) / 1000
+        self.flush_mutations = int(os.getenv('STORAGE_FLUSH_MUTATIONS', 100))
+        self.flush_max_age = float(os.getenv('STORAGE_FLUSH_MAX_AGE_MS', 1000)) / 1000
+        self.fsync = os.getenv('STORAGE_FSYNC', 'false' if self.durability == 'always' else 'true') == 'true'
+        self._pending_records = []  # encoded log records not yet written
+        self._pending_mutations = 0
+        self._pending_since = 0.0  # when the oldest buffered mutation was made
+        self._dirty_collections = set()  # snapshot files changed since the last write
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._flush_thread = None
+        self.writes = 0
+        
         # Load data from storage
         self._load_from_storage()
         
-        # Initialize demo data if needed
+        # Start appending to the log once the existing state is loaded
+        if self.persistence_mode == 'wal':
+            self._open_log()
+        
+        # Seed an empty store
         if not self.users:
-            print("Initializing demo data...")
-            self._initialize_demo_data()
-            self._save_to_storage()
+            self._seed(self._get_seed_mode())
+        
+        # Snapshot the log in the background
+        if self.persistence_mode == 'wal':
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop, daemon=True)
+            self._snapshot_thread.start()
+        
+        # Write buffered mutations in the background
+        if self.durability != 'always':
+            self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flush_thread.start()
     
     def _load_from_storage(self):
         """Load data from file storage"""
         print("Data loaded from storage")
         
+        # Drop temp files left behind by a crash mid-write
+        for directory in (self.storage_dir, self.storage_files['messages']):
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(directory, name))
+        
         try:
             # Load counters
             if os.path.exists(self.storage_files['counters']):
@@ -172,64 +430,447 @@ class InMemoryStorage(Storage):
             # Load chat participants
             if os.path.exists(self.storage_files['chat_participants']):
                 with open(self.storage_files['chat_participants'], 'r') as f:
-                    self.chat_participants = json.load(f)
+                    self.chat_participants = self._decode_collection('chat_participants', json.load(f))
             
-            # Load messages
-            if os.path.exists(self.storage_files['messages']):
-                with open(self.storage_files['messages'], 'r') as f:
-                    self.messages = json.load(f)
+            # Load the message segment indexes, then split up any legacy messages file
+            self.messages.load()
+            if os.path.exists(self.legacy_messages_file):
+                with open(self.legacy_messages_file, 'r') as f:
+                    self.messages.update(self._decode_collection('messages', json.load(f)))
             
             # Load message statuses
             if os.path.exists(self.storage_files['message_statuses']):
                 with open(self.storage_files['message_statuses'], 'r') as f:
-                    self.message_statuses = json.load(f)
+                    self.message_statuses.update(self._decode_collection('message_statuses', json.load(f)))
         
         except Exception as e:
             print(f"Error loading data from storage: {e}")
+        
+        # Replay mutations logged since the last snapshot, oldest log first
+        replayed = 0
+        for log_file in (self.compacting_log_file, self.log_file):
+            replayed += self._replay_log(log_file)
+        
+        # Fold the replayed mutations into the snapshot and drop the logs, but
+        # only once every snapshot file is written. In WAL mode a failed write
+        # keeps the logs for the next compaction; snapshot mode would write new
+        # mutations behind the logs, so it can't start
+        if replayed:
+            print(f"Replayed {replayed} logged mutations")
+            if self._save_to_storage():
+                for log_file in (self.compacting_log_file, self.log_file):
+                    if os.path.exists(log_file):
+                        os.remove(log_file)
+            elif self.persistence_mode == 'wal':
+                print("Keeping the write-ahead log until a snapshot is written")
+            else:
+                raise IOError("Failed to write the replayed write-ahead log to the snapshot files")
+        
+        # Drop the legacy messages file once its messages are in segments,
+        # keeping it to migrate again on the next start if writing them failed
+        if os.path.exists(self.legacy_messages_file):
+            if self._save_to_storage(collections=['counters', 'messages']):
+                print("Migrated messages to segment files")
+                os.remove(self.legacy_messages_file)
+        
+        self._rebuild_indexes()
     
-    def _save_to_storage(self):
-        """Save data to file storage"""
-        print("Data saved to storage")
+    def _rebuild_indexes(self) -> None:
+        """Rebuild all secondary indexes from the loaded collections"""
+        self._user_ids_by_username = {}
+        self._contact_ids_by_user = {}
+        self._participant_ids_by_chat = {}
+        self._chat_ids_by_user = {}
+        self._memberships = set()
+        self._message_ids_by_chat = {}
+        self._latest_message_ids = {}
+        self._unread_counts = {}
+        
+        for user_id_str, user in self.users.items():
+            self._user_ids_by_username[user['username']] = user_id_str
+        
+        for contact_id_str, contact in self.contacts.items():
+            self._index_contact(contact_id_str, contact)
+        
+        for participant in self.chat_participants.values():
+            self._index_participant(participant)
+        
+        # Messages are indexed from the segment indexes, without loading their bodies
+        for message_id, chat_id, sender_id, timestamp in self.messages.iter_meta():
+            self._message_ids_by_chat.setdefault(chat_id, []).append(message_id)
+        for chat_id, message_ids in self._message_ids_by_chat.items():
+            message_ids.sort(key=self._message_sort_key)
+            self._latest_message_ids[chat_id] = message_ids[-1]
+        
+        # The status store indexes itself, only the unread counters are derived here
+        for status_id, message_id, user_id, status in self.message_statuses.iter_rows():
+            self._count_unread(message_id, user_id, None, status)
+    
+    def _index_contact(self, contact_id_str: str, contact: Dict[str, Any]) -> None:
+        """Add a contact to the secondary indexes"""
+        self._contact_ids_by_user.setdefault(contact['userId'], {})[contact['contactId']] = contact_id_str
+    
+    def _index_participant(self, participant: ChatParticipant) -> None:
+        """Add a chat participant to the secondary indexes"""
+        chat_id = participant.chat_id
+        user_id = participant.user_id
+        self._participant_ids_by_chat.setdefault(chat_id, {})[user_id] = participant.id
+        self._chat_ids_by_user.setdefault(user_id, []).append(chat_id)
+        self._memberships.add((chat_id, user_id))
+    
+    def _index_message(self, message: Message) -> None:
+        """Add a message to its chat's timestamp-ordered index"""
+        message_ids = self._message_ids_by_chat.setdefault(message.chat_id, [])
         
-        try:
-            # Save counters
-            counters = {
-                'user_id': self.user_id_counter,
-                'contact_id': self.contact_id_counter,
-                'chat_id': self.chat_id_counter,
-                'chat_participant_id': self.chat_participant_id_counter,
-                'message_id': self.message_id_counter,
-                'message_status_id': self.message_status_id_counter,
-            }
-            with open(self.storage_files['counters'], 'w') as f:
-                json.dump(counters, f)
-            
-            # Save users
-            with open(self.storage_files['users'], 'w') as f:
-                json.dump(self.users, f)
+        # Messages almost always arrive in order, so append unless this one is older
+        if not message_ids or self._message_sort_key(message_ids[-1]) <= self._message_sort_key(message.id):
+            message_ids.append(message.id)
+        else:
+            bisect.insort(message_ids, message.id, key=self._message_sort_key)
+        
+        self._latest_message_ids[message.chat_id] = message_ids[-1]
+    
+    def _count_unread(self, message_id: int, user_id: int, old_status: Optional[str], new_status: str) -> None:
+        """Adjust the unread counter of a chat for a user's message status change"""
+        meta = self.messages.meta(message_id)
+        if not meta or meta[1] == user_id:
+            return
+        
+        # A status counts as unread once it exists and until it becomes 'read'
+        was_unread = old_status is not None and old_status != 'read'
+        is_unread = new_status != 'read'
+        if was_unread == is_unread:
+            return
+        
+        key = (meta[0], user_id)
+        self._unread_counts[key] = self._unread_counts.get(key, 0) + (1 if is_unread else -1)
+    
+    def _message_sort_key(self, message_id: int) -> tuple:
+        """Sort key ordering messages by timestamp, then ID, for int or str IDs alike"""
+        message_id = int(message_id)
+        return (self.messages.meta(message_id)[2], message_id)
+    
+    def _replay_log(self, log_file: str) -> int:
+        """Apply the records of a write-ahead log file, returning how many were applied"""
+        if not os.path.exists(log_file):
+            return 0
+        
+        replayed = 0
+        with open(log_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn record from a crash mid-append, followed by any
+                    # records appended after a restart
+                    print(f"Skipping unreadable record in {log_file}")
+                    continue
+                
+                self._apply_log_record(record)
+                replayed += 1
+        
+        return replayed
+    
+    def _apply_log_record(self, record: Dict[str, Any]) -> None:
+        """Apply a single write-ahead log record to the in-memory state"""
+        # Batch records group several writes into one append
+        if 'b' in record:
+            for batched_record in record['b']:
+                self._apply_log_record(batched_record)
+            return
+        
+        collection = record['c']
+        record_type = self.RECORD_TYPES.get(collection)
+        key = int(record['k']) if record_type else str(record['k'])
+        if record.get('d'):
+            getattr(self, collection).pop(key, None)
+        else:
+            getattr(self, collection)[key] = record_type.from_dict(record['v']) if record_type else record['v']
+        
+        # Keep the ID counter ahead of every replayed record
+        counter = self.COLLECTION_COUNTERS[collection]
+        setattr(self, counter, max(getattr(self, counter), int(key)))
+    
+    def _decode_collection(self, collection: str, records: Dict[str, Any]) -> Dict[Any, Any]:
+        """Convert a collection read from JSON into its in-memory form"""
+        record_type = self.RECORD_TYPES.get(collection)
+        if not record_type:
+            return records
+        return {int(key): record_type.from_dict(value) for key, value in records.items()}
+    
+    def _encode_collection(self, collection: str, records: Dict[Any, Any]) -> Dict[str, Any]:
+        """Convert an in-memory collection into its JSON form"""
+        if collection not in self.RECORD_TYPES:
+            return records
+        return {str(key): record.to_dict() for key, record in records.items()}
+    
+    def _open_log(self) -> None:
+        """Open the write-ahead log for appending"""
+        self._end_log_records(self.log_file)
+        self._log = open(self.log_file, 'a')
+        self._log_bytes = self._log.tell()
+    
+    def _end_log_records(self, log_file: str) -> None:
+        """Terminate a torn final record of a kept log, so records appended after it stay readable"""
+        if not os.path.exists(log_file) or not os.path.getsize(log_file):
+            return
+        with open(log_file, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    
+    def _rotate_log(self) -> None:
+        """Move the current log aside for compaction, appending it to the log
+        kept by a failed compaction so neither is lost"""
+        if not os.path.exists(self.compacting_log_file):
+            os.replace(self.log_file, self.compacting_log_file)
+            return
+        
+        self._end_log_records(self.compacting_log_file)
+        with open(self.log_file, 'rb') as source, open(self.compacting_log_file, 'ab') as target:
+            shutil.copyfileobj(source, target)
+            target.flush()
+            os.fsync(target.fileno())
+        os.remove(self.log_file)
+    
+    def _persist(self, collection: str, key: str) -> None:
+        """Persist a mutated record according to the persistence mode"""
+        self._persist_many([(collection, key)])
+    
+    def _persist_many(self, keys: List[tuple]) -> None:
+        """Persist several mutated (collection, key) records as a single write"""
+        if self._persistence_suspended:
+            return
+        
+        # Encode log records now, so they capture the values as of this mutation.
+        # Records that no longer exist are logged as deletions
+        record = None
+        if self.persistence_mode == 'wal':
+            records = []
+            for collection, key in keys:
+                value = getattr(self, collection).get(key)
+                if value is not None and collection in self.RECORD_TYPES:
+                    value = value.to_dict()
+                records.append({'c': collection, 'k': key, 'v': value} if value is not None else {'c': collection, 'k': key, 'd': 1})
+            record = json.dumps(records[0] if len(records) == 1 else {'b': records}, separators=(',', ':'))
+        
+        with self._pending_lock:
+            if record is not None:
+                self._pending_records.append(record)
             
-            # Save contacts
-            with open(self.storage_files['contacts'], 'w') as f:
-                json.dump(self.contacts, f)
+            # New records advance an ID counter, so the counters file is always rewritten
+            self._dirty_collections.update(collection for collection, key in keys)
+            self._dirty_collections.add('counters')
+            first = not self._pending_mutations
+            if first:
+                self._pending_since = time.monotonic()
+            self._pending_mutations += 1
             
-            # Save chats
-            with open(self.storage_files['chats'], 'w') as f:
-                json.dump(self.chats, f)
+            # Under 'count' the flusher sleeps until a first mutation starts its max age clock
+            wake_flusher = self.durability == 'count' and (first or self._pending_mutations >= self.flush_mutations)
+        
+        # Under 'always' the mutation is written once the storage lock is released
+        if wake_flusher:
+            self._flush_requested.set()
+    
+    def _write_pending(self) -> None:
+        """Write every buffered mutation in one go, so concurrent writers share a single write"""
+        with self._flush_lock:
+            # Take the buffered mutations and capture their snapshot together under
+            # the storage lock, so no mutation is captured half-applied
+            with self._lock:
+                with self._pending_lock:
+                    records, self._pending_records = self._pending_records, []
+                    dirty, self._dirty_collections = self._dirty_collections, set()
+                    self._pending_mutations = 0
+                
+                if not dirty:
+                    return
+                if self.persistence_mode != 'wal':
+                    data = self._snapshot_data(dirty)
             
-            # Save chat participants
-            with open(self.storage_files['chat_participants'], 'w') as f:
-                json.dump(self.chat_participants, f)
+            if self.persistence_mode != 'wal':
+                # Failed files are written again with the next mutation
+                if not self._save_to_storage(data):
+                    with self._pending_lock:
+                        self._dirty_collections.update(dirty)
+                self.writes += 1
+                return
             
-            # Save messages
-            with open(self.storage_files['messages'], 'w') as f:
-                json.dump(self.messages, f)
+            data = ''.join(record + '\n' for record in records)
+            with self._log_lock:
+                self._log.write(data)
+                self._log.flush()
+                if self.fsync:
+                    os.fsync(self._log.fileno())
+                self._log_bytes += len(data)
+                if self._log_bytes >= self.max_log_bytes:
+                    self._compaction_requested.set()
+            self.writes += 1
+    
+    def _flush_loop(self) -> None:
+        """Background loop writing buffered mutations according to the durability policy"""
+        while not self._closed.is_set():
+            self._flush_requested.wait(self._flush_wait())
+            self._flush_requested.clear()
+            if self._closed.is_set() or not self._flush_due():
+                continue
+            try:
+                self._write_pending()
+            except Exception as e:
+                print(f"Error flushing storage: {e}")
+    
+    def _flush_wait(self) -> Optional[float]:
+        """Get how long the flusher can sleep before buffered mutations are due"""
+        if self.durability == 'interval':
+            return self.flush_interval
+        
+        with self._pending_lock:
+            if not self._pending_mutations:
+                return None
+            return max(0.0, self._pending_since + self.flush_max_age - time.monotonic())
+    
+    def _flush_due(self) -> bool:
+        """Check if buffered mutations should be written now"""
+        if self.durability == 'interval':
+            return True
+        
+        with self._pending_lock:
+            if not self._pending_mutations:
+                return False
+            return (self._pending_mutations >= self.flush_mutations or
+                    time.monotonic() - self._pending_since >= self.flush_max_age)
+    
+    def _snapshot_loop(self) -> None:
+        """Background loop compacting the write-ahead log into a snapshot"""
+        while not self._closed.is_set():
+            self._compaction_requested.wait(self.snapshot_interval)
+            self._compaction_requested.clear()
+            if self._closed.is_set():
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Error compacting write-ahead log: {e}")
+    
+    def compact(self) -> None:
+        """Write a snapshot of the current state and truncate the write-ahead log"""
+        if self.persistence_mode != 'wal':
+            with self._pending_lock:
+                self._dirty_collections.update(self.storage_files)
+            self._write_pending()
+            return
+        
+        with self._compaction_lock:
+            with self._log_lock:
+                if not self._log_bytes and not os.path.exists(self.compacting_log_file):
+                    return
+                
+                # Capture the state covered by the current log, then rotate it
+                # so new mutations go to a fresh log while the snapshot is written
+                with self._lock:
+                    data = self._snapshot_data()
+                self._log.close()
+                self._rotate_log()
+                self._open_log()
             
-            # Save message statuses
-            with open(self.storage_files['message_statuses'], 'w') as f:
-                json.dump(self.message_statuses, f)
+            # The rotated log is only dropped once every snapshot file is written
+            if not self._save_to_storage(data):
+                print("Keeping the write-ahead log until a snapshot is written")
+                return
+            os.remove(self.compacting_log_file)
+    
+    def flush(self) -> None:
+        """Write all buffered mutations to disk now"""
+        self._write_pending()
+    
+    def close(self) -> None:
+        """Stop the background threads, write buffered mutations and a final snapshot"""
+        if self._closed.is_set():
+            return
+        
+        self._closed.set()
+        self._compaction_requested.set()
+        self._flush_requested.set()
+        if self._snapshot_thread:
+            self._snapshot_thread.join()
+        if self._flush_thread:
+            self._flush_thread.join()
+        
+        self._write_pending()
+        if self.persistence_mode == 'wal':
+            self.compact()
+        if self._log:
+            with self._log_lock:
+                self._log.close()
+    
+    def _snapshot_data(self, collections: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """Copy the current state of some or all snapshot files' collections,
+        with the storage lock held once the store is in use"""
+        data = {}
+        for collection in (collections if collections is not None else self.storage_files):
+            if collection == 'counters':
+                data['counters'] = {
+                    'user_id': self.user_id_counter,
+                    'contact_id': self.contact_id_counter,
+                    'chat_id': self.chat_id_counter,
+                    'chat_participant_id': self.chat_participant_id_counter,
+                    'message_id': self.message_id_counter,
+                    'message_status_id': self.message_status_id_counter,
+                }
+            elif collection == 'messages':
+                data['messages'] = self.messages.snapshot()
+            elif collection in self.RECORD_TYPES:
+                data[collection] = getattr(self, collection).copy()
+            else:
+                # Plain dict records are updated in place, so copy them as well
+                data[collection] = {key: dict(record) for key, record in getattr(self, collection).items()}
+        return data
+    
+    def _save_to_storage(self, data: Optional[Dict[str, Any]] = None, collections: Optional[Iterable[str]] = None) -> bool:
+        """Save data to file storage, only rewriting the given collections' files if any are named.
+        Returns whether every file was written"""
+        print("Data saved to storage")
+        
+        if data is None:
+            data = self._snapshot_data(collections)
+        
+        try:
+            # Counters first, so a crash never leaves them behind the records they allocated
+            for collection in sorted(data, key=lambda collection: collection != 'counters'):
+                if collection == 'messages':
+                    # Only segments changed since the last snapshot are captured
+                    self.messages.write_snapshot(data['messages'], self._write_json_file)
+                else:
+                    self._write_json_file(self.storage_files[collection], self._encode_collection(collection, data[collection]))
         
         except Exception as e:
             print(f"Error saving data to storage: {e}")
+            return False
+        
+        return True
+    
+    def _write_json_file(self, path: str, value: Any) -> None:
+        """Atomically replace a JSON file via a temp file, so a crash or power loss mid-write keeps the old contents"""
+        directory = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            # Sync the contents before the rename, or a power loss can leave an empty file in place of the old one
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        
+        # Sync the directory so the rename itself survives a crash
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
     
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
@@ -240,11 +881,12 @@ class InMemoryStorage(Storage):
     
     def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
         """Get user by username"""
-        for user_id, user in self.users.items():
-            if user['username'] == username:
-                return user
+        user_id_str = self._user_ids_by_username.get(username)
+        if user_id_str is not None:
+            return self.users[user_id_str]
         return None
     
+    @_mutation
     def create_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create new user"""
         self.user_id_counter += 1
@@ -270,7 +912,8 @@ class InMemoryStorage(Storage):
         }
         
         self.users[user_id_str] = user
-        self._save_to_storage()
+        self._user_ids_by_username[user['username']] = user_id_str
+        self._persist('users', user_id_str)
         
         # If username starts with 'test-', add demo contacts
         if user['username'].startswith('test-'):
@@ -288,6 +931,7 @@ class InMemoryStorage(Storage):
         
         return user_copy
     
+    @_mutation
     def update_user(self, user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
         """Update user data"""
         user_id_str = str(user_id)
@@ -296,13 +940,24 @@ class InMemoryStorage(Storage):
         
         user = self.users[user_id_str]
         
+        # Check if the new username is taken
+        old_username = user['username']
+        new_username = data.get('username', old_username)
+        if new_username != old_username and new_username in self._user_ids_by_username:
+            raise ValueError(f"Username '{new_username}' already exists")
+        
         # Update user data
         for key, value in data.items():
             if key != 'id' and key != 'password':  # Don't update ID or password this way
                 user[key] = value
         
+        # Re-index a changed username
+        if new_username != old_username:
+            self._user_ids_by_username.pop(old_username, None)
+            self._user_ids_by_username[new_username] = user_id_str
+        
         user['updatedAt'] = int(time.time() * 1000)
-        self._save_to_storage()
+        self._persist('users', user_id_str)
         
         # Create copy without password
         user_copy = user.copy()
@@ -310,6 +965,7 @@ class InMemoryStorage(Storage):
         
         return user_copy
     
+    @_mutation
     def update_user_status(self, user_id: int, is_online: bool) -> Dict[str, Any]:
         """Update user online status"""
         user_id_str = str(user_id)
@@ -326,7 +982,7 @@ class InMemoryStorage(Storage):
             user['lastSeen'] = int(time.time() * 1000)
         
         user['updatedAt'] = int(time.time() * 1000)
-        self._save_to_storage()
+        self._persist('users', user_id_str)
         
         # Create copy without password
         user_copy = user.copy()
@@ -334,40 +990,56 @@ class InMemoryStorage(Storage):
         
         return user_copy
     
+    @_mutation
+    def update_user_password(self, user_id: int, password_hash: str) -> None:
+        """Replace a user's password hash"""
+        user_id_str = str(user_id)
+        if user_id_str not in self.users:
+            raise ValueError(f"User with ID {user_id} not found")
+        
+        user = self.users[user_id_str]
+        user['password'] = password_hash
+        user['updatedAt'] = int(time.time() * 1000)
+        self._persist('users', user_id_str)
+    
     def get_contacts_by_user_id(self, user_id: int) -> List[Dict[str, Any]]:
         """Get contacts for user"""
         user_contacts = []
         
-        for contact_id, contact in self.contacts.items():
-            if contact['userId'] == user_id:
-                # Get the contact user details
-                contact_user = self.get_user(contact['contactId'])
-                if contact_user:
-                    contact_user_copy = contact_user.copy()
-                    contact_user_copy.pop('password', None)  # Remove password
-                    
-                    # Merge contact and user details
-                    contact_data = {**contact, 'user': contact_user_copy}
-                    user_contacts.append(contact_data)
+        for contact_id_str in self._contact_ids_by_user.get(user_id, {}).values():
+            contact = self.contacts[contact_id_str]
+            # Get the contact user details
+            contact_user = self.get_user(contact['contactId'])
+            if contact_user:
+                contact_user_copy = contact_user.copy()
+                contact_user_copy.pop('password', None)  # Remove password
+                
+                # Merge contact and user details
+                contact_data = {**contact, 'user': contact_user_copy}
+                user_contacts.append(contact_data)
         
         return user_contacts
     
     def get_contact_by_user_and_contact_id(self, user_id: int, contact_id: int) -> Optional[Dict[str, Any]]:
         """Get contact by user ID and contact ID"""
-        for c_id, contact in self.contacts.items():
-            if contact['userId'] == user_id and contact['contactId'] == contact_id:
-                # Get the contact user details
-                contact_user = self.get_user(contact['contactId'])
-                if contact_user:
-                    contact_user_copy = contact_user.copy()
-                    contact_user_copy.pop('password', None)  # Remove password
-                    
-                    # Merge contact and user details
-                    contact_data = {**contact, 'user': contact_user_copy}
-                    return contact_data
+        contact_id_str = self._contact_ids_by_user.get(user_id, {}).get(contact_id)
+        if contact_id_str is None:
+            return None
+        
+        contact = self.contacts[contact_id_str]
+        # Get the contact user details
+        contact_user = self.get_user(contact['contactId'])
+        if contact_user:
+            contact_user_copy = contact_user.copy()
+            contact_user_copy.pop('password', None)  # Remove password
+            
+            # Merge contact and user details
+            contact_data = {**contact, 'user': contact_user_copy}
+            return contact_data
         
         return None
     
+    @_mutation
     def create_contact(self, contact_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create new contact"""
         self.contact_id_counter += 1
@@ -410,7 +1082,8 @@ class InMemoryStorage(Storage):
         }
         
         self.contacts[contact_id_str] = contact
-        self._save_to_storage()
+        self._index_contact(contact_id_str, contact)
+        self._persist('contacts', contact_id_str)
         
         # Get the contact user details
         contact_user_copy = contact_user.copy()
@@ -425,20 +1098,18 @@ class InMemoryStorage(Storage):
         """Get chats for user"""
         user_chats = []
         
-        # Find chat participants for the user
-        user_chat_ids = []
-        for participant_id, participant in self.chat_participants.items():
-            if participant['userId'] == user_id:
-                user_chat_ids.append(participant['chatId'])
-        
-        # Get chat details for each chat
-        for chat_id in user_chat_ids:
+        # Get chat details for each chat the user participates in
+        for chat_id in self._chat_ids_by_user.get(user_id, []):
             chat = self.get_chat_by_id(chat_id, user_id)
             if chat:
                 user_chats.append(chat)
         
         return user_chats
     
+    def get_chat_ids_by_user_id(self, user_id: int) -> List[int]:
+        """Get the IDs of the chats a user participates in"""
+        return list(self._chat_ids_by_user.get(user_id, []))
+    
     def get_chat_by_id(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
         """Get chat by ID"""
         chat_id_str = str(chat_id)
@@ -455,18 +1126,18 @@ class InMemoryStorage(Storage):
         participants = self.get_chat_participants(chat_id)
         
         # Get latest message
-        chat_messages = self.get_messages_by_chat_id(chat_id)
         latest_message = None
-        if chat_messages:
-            latest_message = max(chat_messages, key=lambda m: m['timestamp'])
+        latest_message_id = self._latest_message_ids.get(chat_id)
+        if latest_message_id is not None:
+            message = self.messages[latest_message_id]
+            sender = self.get_user(message.sender_id)
+            if sender:
+                sender_copy = sender.copy()
+                sender_copy.pop('password', None)  # Remove password
+                latest_message = {**message.to_dict(), 'sender': sender_copy}
         
         # Get unread messages count for the user
-        unread_count = 0
-        for message in chat_messages:
-            if message['senderId'] != user_id:
-                message_status = self.get_message_status_by_message_and_user_id(message['id'], user_id)
-                if message_status and message_status['status'] != 'read':
-                    unread_count += 1
+        unread_count = self._unread_counts.get((chat_id, user_id), 0)
         
         # Enrich chat object
         chat_data = {
@@ -478,23 +1149,39 @@ class InMemoryStorage(Storage):
         
         return chat_data
     
+    def get_direct_chat_ids(self, user_id: int, contact_ids: List[int]) -> Dict[int, int]:
+        """Get the IDs of the two-person chats between a user and each of the given contacts, keyed by contact"""
+        wanted = set(contact_ids)
+        chat_ids = {}
+        for chat_id in self._chat_ids_by_user.get(user_id, []):
+            participant_ids = self._participant_ids_by_chat.get(chat_id, {})
+            if len(participant_ids) != 2:
+                continue
+            
+            # Keep the first matching chat, as get_chat_by_participants does
+            other_id = next(participant_id for participant_id in participant_ids if participant_id != user_id)
+            if other_id in wanted:
+                chat_ids.setdefault(other_id, chat_id)
+        
+        return chat_ids
+    
     def get_chat_by_participants(self, participant_ids: List[int]) -> Optional[Dict[str, Any]]:
         """Get chat by participant IDs"""
-        # Find chats where all participants are present
-        for chat_id, chat in self.chats.items():
-            chat_id_int = int(chat_id)
-            
+        if not participant_ids:
+            return None
+        
+        # Only chats of the first participant can contain all of them
+        for chat_id in self._chat_ids_by_user.get(participant_ids[0], []):
             # Get all participants for this chat
-            chat_participant_ids = []
-            for participant in self.get_chat_participants(chat_id_int):
-                chat_participant_ids.append(participant['userId'])
+            chat_participant_ids = list(self._participant_ids_by_chat.get(chat_id, {}))
             
             # Check if participants match exactly
             if sorted(chat_participant_ids) == sorted(participant_ids) and len(chat_participant_ids) == len(participant_ids):
-                return self.get_chat_by_id(chat_id_int, participant_ids[0])
+                return self.get_chat_by_id(chat_id, participant_ids[0])
         
         return None
     
+    @_mutation
     def create_chat(self, chat_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create new chat"""
         self.chat_id_counter += 1
@@ -516,7 +1203,7 @@ class InMemoryStorage(Storage):
         }
         
         self.chats[chat_id_str] = chat
-        self._save_to_storage()
+        self._persist('chats', chat_id_str)
         
         # Add participants
         participants = []
@@ -539,25 +1226,25 @@ class InMemoryStorage(Storage):
         """Get participants for chat"""
         chat_participants = []
         
-        for participant_id, participant in self.chat_participants.items():
-            if participant['chatId'] == chat_id:
-                # Get the user details
-                user = self.get_user(participant['userId'])
-                if user:
-                    user_copy = user.copy()
-                    user_copy.pop('password', None)  # Remove password
-                    
-                    # Merge participant and user details
-                    participant_data = {**participant, 'user': user_copy}
-                    chat_participants.append(participant_data)
+        for participant_id in self._participant_ids_by_chat.get(chat_id, {}).values():
+            participant = self.chat_participants[participant_id]
+            # Get the user details
+            user = self.get_user(participant.user_id)
+            if user:
+                user_copy = user.copy()
+                user_copy.pop('password', None)  # Remove password
+                
+                # Merge participant and user details
+                participant_data = {**participant.to_dict(), 'user': user_copy}
+                chat_participants.append(participant_data)
         
         return chat_participants
     
+    @_mutation
     def add_chat_participant(self, participant_data: Dict[str, Any]) -> Dict[str, Any]:
         """Add participant to chat"""
         self.chat_participant_id_counter += 1
         participant_id = self.chat_participant_id_counter
-        participant_id_str = str(participant_id)
         
         # Check if chat exists
         chat_id = participant_data['chatId']
@@ -576,59 +1263,143 @@ class InMemoryStorage(Storage):
             raise ValueError(f"User with ID {user_id} is already a participant in chat with ID {chat_id}")
         
         # Create participant
-        participant = {
-            'id': participant_id,
-            'chatId': chat_id,
-            'userId': user_id,
-            'role': participant_data.get('role', 'member'),  # admin, member
-            'joinedAt': int(time.time() * 1000),
-        }
+        participant = ChatParticipant(
+            participant_id,
+            chat_id,
+            user_id,
+            participant_data.get('role', 'member'),  # admin, member
+            int(time.time() * 1000),
+        )
         
-        self.chat_participants[participant_id_str] = participant
-        self._save_to_storage()
+        self.chat_participants[participant_id] = participant
+        self._index_participant(participant)
+        self._persist('chat_participants', participant_id)
+        self._notify_membership_changed(chat_id, user_id, True)
         
         # Get the user details
         user_copy = user.copy()
         user_copy.pop('password', None)  # Remove password
         
         # Merge participant and user details
-        participant_data = {**participant, 'user': user_copy}
+        participant_data = {**participant.to_dict(), 'user': user_copy}
         
         return participant_data
     
+    @_mutation
+    def remove_chat_participant(self, chat_id: int, user_id: int) -> None:
+        """Remove participant from chat"""
+        participant_id = self._participant_ids_by_chat.get(chat_id, {}).pop(user_id, None)
+        if participant_id is None:
+            raise ValueError(f"User with ID {user_id} is not a participant in chat with ID {chat_id}")
+        
+        # Remove the participant and its index entries
+        del self.chat_participants[participant_id]
+        self._chat_ids_by_user[user_id].remove(chat_id)
+        self._memberships.discard((chat_id, user_id))
+        self._unread_counts.pop((chat_id, user_id), None)
+        self._persist('chat_participants', participant_id)
+        self._notify_membership_changed(chat_id, user_id, False)
+    
     def is_chat_participant(self, chat_id: int, user_id: int) -> bool:
         """Check if user is participant in chat"""
-        for participant_id, participant in self.chat_participants.items():
-            if participant['chatId'] == chat_id and participant['userId'] == user_id:
-                return True
-        return False
+        return (chat_id, user_id) in self._memberships
+    
+    def get_chat_participant_ids(self, chat_id: int) -> List[int]:
+        """Get the user IDs of a chat's participants"""
+        return list(self._participant_ids_by_chat.get(chat_id, {}))
     
     def get_messages_by_chat_id(self, chat_id: int) -> List[Dict[str, Any]]:
         """Get messages for chat"""
         chat_messages = []
         
-        for message_id, message in self.messages.items():
-            if message['chatId'] == chat_id:
-                # Enrich message with sender details
-                sender = self.get_user(message['senderId'])
-                if sender:
-                    sender_copy = sender.copy()
-                    sender_copy.pop('password', None)  # Remove password
-                    
-                    # Enrich message object
-                    message_data = {**message, 'sender': sender_copy}
-                    chat_messages.append(message_data)
-        
-        # Sort by timestamp
-        chat_messages.sort(key=lambda m: m['timestamp'])
+        # The chat index is already ordered by timestamp
+        for message_id in self._message_ids_by_chat.get(chat_id, []):
+            message = self.messages[message_id]
+            # Enrich message with sender details
+            sender = self.get_user(message.sender_id)
+            if sender:
+                sender_copy = sender.copy()
+                sender_copy.pop('password', None)  # Remove password
+                
+                # Enrich message object
+                message_data = {**message.to_dict(), 'sender': sender_copy}
+                chat_messages.append(message_data)
         
         return chat_messages
     
+    def get_messages_page(self, chat_id: int, before: Optional[int] = None, after: Optional[int] = None,
+                          limit: int = DEFAULT_MESSAGE_PAGE_SIZE) -> Dict[str, Any]:
+        """Get a page of chat messages before or after a cursor message ID"""
+        if before is not None and after is not None:
+            raise ValueError("Only one of 'before' and 'after' can be given")
+        limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+        
+        message_ids = self._message_ids_by_chat.get(chat_id, [])
+        cursor = before if before is not None else after
+        
+        # Locate the cursor message in the chat's ordered index
+        if cursor is not None:
+            cursor_meta = self.messages.meta(int(cursor))
+            if not cursor_meta or cursor_meta[0] != chat_id:
+                raise ValueError(f"Message with ID {cursor} not found in chat with ID {chat_id}")
+            position = bisect.bisect_left(message_ids, self._message_sort_key(cursor), key=self._message_sort_key)
+        
+        # Select the page, and the message to continue from if there is more
+        if after is not None:
+            start = position + 1
+            end = min(start + limit, len(message_ids))
+            page_ids = message_ids[start:end]
+            has_more = end < len(message_ids)
+        else:
+            end = position if before is not None else len(message_ids)
+            start = max(0, end - limit)
+            page_ids = message_ids[start:end]
+            has_more = start > 0
+        
+        next_cursor = None
+        if has_more and page_ids:
+            next_cursor = page_ids[-1] if after is not None else page_ids[0]
+        
+        # Enrich messages with sender details
+        messages = []
+        for message_id in page_ids:
+            message = self.messages[message_id]
+            sender = self.get_user(message.sender_id)
+            if sender:
+                sender_copy = sender.copy()
+                sender_copy.pop('password', None)  # Remove password
+                messages.append({**message.to_dict(), 'sender': sender_copy})
+        
+        return {
+            'messages': messages,
+            'nextCursor': next_cursor,
+        }
+    
+    def get_recent_messages_by_chat_ids(self, chat_ids: List[int], limit: int = 5) -> Dict[int, List[Dict[str, Any]]]:
+        """Get the latest messages of several chats, oldest first, keyed by chat"""
+        # Each chat's page is a slice of its ordered index, so there is nothing to batch
+        return {chat_id: self.get_messages_page(chat_id, limit=limit)['messages'] for chat_id in chat_ids}
+    
+    def get_message(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """Get message by ID"""
+        message = self.messages.get(to_id(message_id, 'message ID'))
+        if not message:
+            return None
+        
+        # Enrich message with sender details
+        sender = self.get_user(message.sender_id)
+        if not sender:
+            return None
+        sender_copy = sender.copy()
+        sender_copy.pop('password', None)  # Remove password
+        
+        return {**message.to_dict(), 'sender': sender_copy}
+    
+    @_mutation
     def create_message(self, message_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create new message"""
         self.message_id_counter += 1
         message_id = self.message_id_counter
-        message_id_str = str(message_id)
         
         # Check if chat exists
         chat_id = message_data['chatId']
@@ -647,52 +1418,121 @@ class InMemoryStorage(Storage):
             raise ValueError(f"User with ID {sender_id} is not a participant in chat with ID {chat_id}")
         
         # Create message
-        message = {
-            'id': message_id,
-            'chatId': chat_id,
-            'senderId': sender_id,
-            'content': message_data['content'],
-            'type': message_data.get('type', 'text'),  # text, image, video, audio, file
-            'quotedMessageId': message_data.get('quotedMessageId', None),
-            'timestamp': message_data.get('timestamp', int(time.time() * 1000)),
-            'status': message_data.get('status', 'sent'),  # sent, delivered, read
-        }
+        message = Message(
+            message_id,
+            chat_id,
+            sender_id,
+            message_data['content'],
+            message_data.get('type', 'text'),  # text, image, video, audio, file
+            message_data.get('quotedMessageId', None),
+            message_data.get('timestamp', int(time.time() * 1000)),
+            message_data.get('status', 'sent'),  # sent, delivered, read
+        )
         
-        self.messages[message_id_str] = message
-        self._save_to_storage()
+        self.messages[message_id] = message
+        self._index_message(message)
         
         # Update chat's updatedAt timestamp
         chat = self.chats[chat_id_str]
         chat['updatedAt'] = int(time.time() * 1000)
-        self._save_to_storage()
+        self._persist_many([('messages', message_id), ('chats', chat_id_str)])
         
         # Get the sender details
         sender_copy = sender.copy()
         sender_copy.pop('password', None)  # Remove password
         
         # Enrich message object
-        message_data = {**message, 'sender': sender_copy}
+        message_data = {**message.to_dict(), 'sender': sender_copy}
         
         return message_data
     
+    @_mutation
+    def create_message_with_statuses(self, message_data: Dict[str, Any], participant_ids: List[int]) -> Dict[str, Any]:
+        """Create a message and its statuses for all participants in one batch"""
+        # Check if chat exists
+        chat_id = message_data['chatId']
+        chat_id_str = str(chat_id)
+        if chat_id_str not in self.chats:
+            raise ValueError(f"Chat with ID {chat_id} not found")
+        
+        # Check if sender exists
+        sender_id = message_data['senderId']
+        sender = self.get_user(sender_id)
+        if not sender:
+            raise ValueError(f"User with ID {sender_id} not found")
+        
+        # Check if sender is a participant
+        if not self.is_chat_participant(chat_id, sender_id):
+            raise ValueError(f"User with ID {sender_id} is not a participant in chat with ID {chat_id}")
+        
+        # Check if all recipients exist
+        recipient_ids = list(dict.fromkeys(participant_ids))
+        for user_id in recipient_ids:
+            if not self.get_user(user_id):
+                raise ValueError(f"User with ID {user_id} not found")
+        
+        # Create message
+        self.message_id_counter += 1
+        message_id = self.message_id_counter
+        message = Message(
+            message_id,
+            chat_id,
+            sender_id,
+            message_data['content'],
+            message_data.get('type', 'text'),  # text, image, video, audio, file
+            message_data.get('quotedMessageId', None),
+            message_data.get('timestamp', int(time.time() * 1000)),
+            message_data.get('status', 'sent'),  # sent, delivered, read
+        )
+        self.messages[message_id] = message
+        self._index_message(message)
+        
+        # Update chat's updatedAt timestamp
+        chat = self.chats[chat_id_str]
+        chat['updatedAt'] = int(time.time() * 1000)
+        written = [('messages', message_id), ('chats', chat_id_str)]
+        
+        # Create statuses: 'sent' for the sender, 'delivered' for everyone else
+        for user_id in recipient_ids:
+            self.message_status_id_counter += 1
+            status_id = self.message_status_id_counter
+            status = MessageStatus(
+                status_id,
+                message_id,
+                user_id,
+                'sent' if user_id == sender_id else 'delivered',
+                message.timestamp,
+            )
+            self.message_statuses[status_id] = status
+            self._count_unread(message_id, user_id, None, status.status)
+            written.append(('message_statuses', status_id))
+        
+        self._persist_many(written)
+        
+        # Get the sender details
+        sender_copy = sender.copy()
+        sender_copy.pop('password', None)  # Remove password
+        
+        # Enrich message object
+        return {**message.to_dict(), 'sender': sender_copy}
+    
     def get_message_status_by_message_and_user_id(self, message_id: int, user_id: int) -> Optional[Dict[str, Any]]:
         """Get message status by message ID and user ID"""
-        for status_id, status in self.message_statuses.items():
-            if status['messageId'] == message_id and status['userId'] == user_id:
-                return status
+        status_id = self.message_statuses.find(to_id(message_id, 'message ID'), to_id(user_id, 'user ID'))
+        if status_id is not None:
+            return self.message_statuses[status_id].to_dict()
         
         return None
     
+    @_mutation
     def create_message_status(self, status_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create message status"""
         self.message_status_id_counter += 1
         status_id = self.message_status_id_counter
-        status_id_str = str(status_id)
         
         # Check if message exists
         message_id = status_data['messageId']
-        message_id_str = str(message_id)
-        if message_id_str not in self.messages:
+        if message_id not in self.messages:
             raise ValueError(f"Message with ID {message_id} not found")
         
         # Check if user exists
@@ -702,71 +1542,156 @@ class InMemoryStorage(Storage):
             raise ValueError(f"User with ID {user_id} not found")
         
         # Check if status already exists
-        existing_status = self.get_message_status_by_message_and_user_id(message_id, user_id)
-        if existing_status:
+        if self.message_statuses.find(message_id, user_id) is not None:
             raise ValueError(f"Status already exists for message with ID {message_id} and user with ID {user_id}")
         
         # Create status
-        status = {
-            'id': status_id,
-            'messageId': message_id,
-            'userId': user_id,
-            'status': status_data['status'],  # sent, delivered, read
-            'timestamp': status_data.get('timestamp', int(time.time() * 1000)),
-        }
+        status = MessageStatus(
+            status_id,
+            message_id,
+            user_id,
+            status_data['status'],  # sent, delivered, read
+            status_data.get('timestamp', int(time.time() * 1000)),
+        )
         
-        self.message_statuses[status_id_str] = status
-        self._save_to_storage()
+        self.message_statuses[status_id] = status
+        self._count_unread(message_id, user_id, None, status.status)
+        self._persist('message_statuses', status_id)
         
-        return status
+        return status.to_dict()
     
-    def update_message_status(self, message_id: int, user_id: int, status: str) -> Dict[str, Any]:
-        """Update message status"""
+    @_mutation
+    def update_message_status(self, message_id: int, user_id: int, status: str) -> Optional[Dict[str, Any]]:
+        """Update message status, returning None for an unknown status name"""
+        # Reject unknown statuses and malformed IDs before any counter changes
+        if status not in STATUS_CODES:
+            return None
+        message_id, user_id = to_id(message_id, 'message ID'), to_id(user_id, 'user ID')
+        
         # Check if status exists
-        existing_status = self.get_message_status_by_message_and_user_id(message_id, user_id)
-        if not existing_status:
+        status_id = self.message_statuses.find(message_id, user_id)
+        if status_id is None:
             raise ValueError(f"Status not found for message with ID {message_id} and user with ID {user_id}")
         
         # Update status
-        status_id_str = str(existing_status['id'])
-        self.message_statuses[status_id_str]['status'] = status
-        self.message_statuses[status_id_str]['timestamp'] = int(time.time() * 1000)
-        self._save_to_storage()
+        self._count_unread(message_id, user_id, self.message_statuses.status_of(status_id), status)
+        self.message_statuses.set_status(status_id, status, int(time.time() * 1000))
+        self._persist('message_statuses', status_id)
         
         # Update message status if all participants have read
         if status == 'read':
             self._update_message_status_if_all(message_id)
         
-        return self.message_statuses[status_id_str]
+        return self.message_statuses[status_id].to_dict()
     
-    def _update_message_status_if_all(self, message_id: int) -> None:
-        """Update message status if all participants have read the message"""
-        message_id_str = str(message_id)
-        if message_id_str not in self.messages:
-            return
-        
-        message = self.messages[message_id_str]
-        chat_id = message['chatId']
-        sender_id = message['senderId']
+    @_mutation
+    def mark_messages_read_up_to(self, chat_id: int, user_id: int, message_id: Optional[int] = None,
+                                 timestamp: Optional[int] = None) -> List[int]:
+        """Mark a user's unread messages in a chat as read in one batch"""
+        if message_id is None and timestamp is None:
+            raise ValueError("Either a message ID or a timestamp is required")
+        if message_id is not None:
+            message_id = to_id(message_id, 'message ID')
+        
+        # Find where the read range ends in the chat's ordered index
+        message_ids = self._message_ids_by_chat.get(chat_id, [])
+        if message_id is not None:
+            message_meta = self.messages.meta(message_id)
+            if not message_meta or message_meta[0] != chat_id:
+                raise ValueError(f"Message with ID {message_id} not found in chat with ID {chat_id}")
+            end = bisect.bisect_right(message_ids, self._message_sort_key(message_id), key=self._message_sort_key)
+        else:
+            end = bisect.bisect_right(message_ids, (timestamp, float('inf')), key=self._message_sort_key)
+        
+        # The unread counter bounds how many unread messages exist, so the scan
+        # back from the end of the range can stop once all of them are found
+        remaining = self._unread_counts.get((chat_id, user_id), 0)
+        for later_message_id in message_ids[end:]:
+            if not remaining:
+                break
+            if self._is_unread(later_message_id, user_id):
+                remaining -= 1
+        
+        now = int(time.time() * 1000)
+        read_message_ids = []
+        written = []
+        for position in range(end - 1, -1, -1):
+            if not remaining:
+                break
+            
+            read_message_id = message_ids[position]
+            if not self._is_unread(read_message_id, user_id):
+                continue
+            remaining -= 1
+            
+            # Update status
+            status_id = self.message_statuses.find(read_message_id, user_id)
+            self._count_unread(read_message_id, user_id, self.message_statuses.status_of(status_id), 'read')
+            self.message_statuses.set_status(status_id, 'read', now)
+            written.append(('message_statuses', status_id))
+            
+            # Update message status if all participants have read
+            if self._update_message_status_if_all(read_message_id, persist=False):
+                written.append(('messages', read_message_id))
+            read_message_ids.append(read_message_id)
         
-        # Get all participants except sender
-        participants = []
-        for participant in self.get_chat_participants(chat_id):
-            if participant['userId'] != sender_id:
-                participants.append(participant)
+        if written:
+            self._persist_many(written)
         
-        # Check if all participants have read
+        read_message_ids.reverse()
+        return read_message_ids
+    
+    def _is_unread(self, message_id: int, user_id: int) -> bool:
+        """Check if a message from someone else is unread by the user"""
+        if self.messages.meta(message_id)[1] == user_id:
+            return False
+        status_id = self.message_statuses.find(message_id, user_id)
+        return status_id is not None and self.message_statuses.status_of(status_id) != 'read'
+    
+    def _update_message_status_if_all(self, message_id: int, persist: bool = True) -> bool:
+        """Update message status if all participants have read the message,
+        returning whether the message changed"""
+        meta = self.messages.meta(message_id)
+        if not meta:
+            return False
+        chat_id, sender_id, timestamp = meta
+        
+        # Count all participants except sender
+        participant_ids = self._participant_ids_by_chat.get(chat_id, {})
+        recipient_count = len(participant_ids) - (1 if sender_id in participant_ids else 0)
+        
+        # Every recipient needs a read status, so fewer reads than recipients
+        # rules it out without visiting them
+        reads = self.message_statuses.read_count(message_id)
+        sender_status_id = self.message_statuses.find(message_id, sender_id)
+        if sender_status_id is not None and self.message_statuses.status_of(sender_status_id) == 'read':
+            reads -= 1
+        if reads < recipient_count:
+            return False
+        
+        message = self.messages[message_id]
+        if message.status == 'read':
+            return False
+        
+        # Reads by former participants can make up the count, so confirm once before flipping
         all_read = True
-        for participant in participants:
-            status = self.get_message_status_by_message_and_user_id(message_id, participant['userId'])
-            if not status or status['status'] != 'read':
+        for participant_id in participant_ids:
+            if participant_id == sender_id:
+                continue
+            status_id = self.message_statuses.find(message_id, participant_id)
+            if status_id is None or self.message_statuses.status_of(status_id) != 'read':
                 all_read = False
                 break
         
         # Update message status if all read
         if all_read:
-            message['status'] = 'read'
-            self._save_to_storage()
+            message.status = 'read'
+            self.messages[message_id] = message
+            if persist:
+                self._persist('messages', message_id)
+            return True
+        
+        return False
     
     def _add_demo_contacts_for_user(self, user_id: int) -> None:
         """Add demo contacts for user"""
@@ -850,6 +1775,30 @@ class InMemoryStorage(Storage):
         except ValueError:
             pass  # Contact already exists
     
+    def _seed(self, seed_mode: str) -> None:
+        """Seed an empty store with demo data, writing it to storage once"""
+        if seed_mode == 'none':
+            return
+        
+        if seed_mode == 'fixture':
+            print("Seeding demo data from fixture...")
+            fixture = load_demo_fixture()
+            for collection in self.COLLECTION_COUNTERS:
+                getattr(self, collection).update(self._decode_collection(collection, fixture.get(collection, {})))
+            for name, value in fixture.get('counters', {}).items():
+                setattr(self, f"{name}_counter", value)
+            self._rebuild_indexes()
+        else:
+            # Skip the per-mutation writes, the seeded state is saved once below
+            print("Initializing demo data...")
+            self._persistence_suspended = True
+            try:
+                self._initialize_demo_data()
+            finally:
+                self._persistence_suspended = False
+        
+        self._save_to_storage()
+    
     def _initialize_demo_data(self):
         """Initialize demo data for testing"""
         # Create a demo user
@@ -865,11 +1814,53 @@ class InMemoryStorage(Storage):
         # Add Islamic scholar contacts
         self._add_islamic_scholar_contacts_for_user(demo_user['id'])
 
+class IdBlockAllocator:
+    """Hi/lo ID allocator reserving blocks of IDs from MongoDB counter documents.
+    
+    Each process reserves a range of IDs with one atomic increment and then
+    hands them out locally, so inserts don't need a counter round-trip and
+    concurrent workers only touch a counter document once per block.
+    """
+    
+    def __init__(self, counters_collection, block_size: int):
+        """Initialize the allocator"""
+        if block_size < 1:
+            raise ValueError("ID block size must be at least 1")
+        
+        self.counters_collection = counters_collection
+        self.block_size = block_size
+        self._blocks = {}  # counter name -> [next ID, last reserved ID]
+        self._locks = {}  # counter name -> lock
+        self._locks_lock = threading.Lock()
+    
+    def next_id(self, name: str) -> int:
+        """Get the next ID for a counter, reserving a new block if needed"""
+        with self._locks_lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        
+        with lock:
+            block = self._blocks.get(name)
+            if not block or block[0] > block[1]:
+                counter = self.counters_collection.find_one_and_update(
+                    {'_id': name},
+                    {'$inc': {'seq': self.block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                block = [counter['seq'] - self.block_size + 1, counter['seq']]
+                self._blocks[name] = block
+            
+            next_id = block[0]
+            block[0] += 1
+            return next_id
+
 class MongoStorage(Storage):
     """MongoDB storage implementation"""
     
     def __init__(self):
         """Initialize MongoDB storage"""
+        super().__init__()
+        
         # Get MongoDB URI from environment
         mongodb_uri = os.getenv('MONGODB_URI')
         
@@ -890,10 +1881,17 @@ class MongoStorage(Storage):
         self.counters_collection = self.db['counters']
         
         # Ensure indexes
+        for collection in (self.users_collection, self.contacts_collection, self.chats_collection,
+                           self.chat_participants_collection, self.messages_collection,
+                           self.message_statuses_collection):
+            collection.create_index('id', unique=True)
         self.users_collection.create_index('username', unique=True)
         self.contacts_collection.create_index([('userId', 1), ('contactId', 1)], unique=True)
         self.chat_participants_collection.create_index([('chatId', 1), ('userId', 1)], unique=True)
+        self.chat_participants_collection.create_index([('userId', 1), ('id', 1)])
         self.message_statuses_collection.create_index([('messageId', 1), ('userId', 1)], unique=True)
+        self.message_statuses_collection.create_index([('userId', 1), ('status', 1)])
+        self.messages_collection.create_index([('chatId', 1), ('timestamp', 1), ('id', 1)])
         
         # Initialize counters if needed
         counters = ['user_id', 'contact_id', 'chat_id', 'chat_participant_id', 'message_id', 'message_status_id']
@@ -901,19 +1899,35 @@ class MongoStorage(Storage):
             if not self.counters_collection.find_one({'_id': counter}):
                 self.counters_collection.insert_one({'_id': counter, 'seq': 0})
         
-        # Initialize demo data if needed
+        # Multi-document transactions need a replica set or a sharded cluster
+        self.supports_transactions = self._detect_transactions()
+        
+        # Allocate IDs in blocks to avoid a counter round-trip per insert
+        block_size = int(os.getenv('MONGODB_ID_BLOCK_SIZE', 100))
+        self.id_allocator = IdBlockAllocator(self.counters_collection, block_size)
+        
+        # Seed an empty database
         if self.users_collection.count_documents({}) == 0:
-            print("Initializing demo data...")
-            self._initialize_demo_data()
+            self._seed(self._get_seed_mode())
+    
+    def _detect_transactions(self) -> bool:
+        """Check if the server supports multi-document transactions"""
+        setting = os.getenv('MONGODB_TRANSACTIONS', 'auto')
+        if setting != 'auto':
+            return setting == 'true'
+        try:
+            hello = self.client.admin.command('hello')
+        except Exception:
+            return False
+        return 'setName' in hello or hello.get('msg') == 'isdbgrid'
     
     def _get_next_sequence(self, name: str) -> int:
         """Get the next sequence value for a counter"""
-        counter = self.counters_collection.find_one_and_update(
-            {'_id': name},
-            {'$inc': {'seq': 1}},
-            return_document=True
-        )
-        return counter['seq']
+        return self.id_allocator.next_id(name)
+    
+    def close(self) -> None:
+        """Close the MongoDB client"""
+        self.client.close()
     
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
@@ -974,6 +1988,721 @@ class MongoStorage(Storage):
         
         return user_copy
     
+    def update_user(self, user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Update user data"""
+        # Don't update ID or password this way
+        updates = {key: value for key, value in data.items() if key not in ('id', 'password', '_id')}
+        updates['updatedAt'] = int(time.time() * 1000)
+        
+        try:
+            user = self.users_collection.find_one_and_update(
+                {'id': user_id},
+                {'$set': updates},
+                projection=USER_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            raise ValueError(f"Username '{updates.get('username')}' already exists")
+        
+        if not user:
+            raise ValueError(f"User with ID {user_id} not found")
+        
+        return user
+    
+    def update_user_status(self, user_id: int, is_online: bool) -> Dict[str, Any]:
+        """Update user online status"""
+        now = int(time.time() * 1000)
+        updates = {'isOnline': is_online, 'updatedAt': now}
+        
+        # Update last seen if going offline
+        if not is_online:
+            updates['lastSeen'] = now
+        
+        user = self.users_collection.find_one_and_update(
+            {'id': user_id},
+            {'$set': updates},
+            projection=USER_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if not user:
+            raise ValueError(f"User with ID {user_id} not found")
+        
+        return user
+    
+    def update_user_password(self, user_id: int, password_hash: str) -> None:
+        """Replace a user's password hash"""
+        result = self.users_collection.update_one(
+            {'id': user_id},
+            {'$set': {'password': password_hash, 'updatedAt': int(time.time() * 1000)}}
+        )
+        if not result.matched_count:
+            raise ValueError(f"User with ID {user_id} not found")
+    
+    def _contact_pipeline(self, match: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Aggregation pipeline returning contacts enriched with their user"""
+        return [
+            {'$match': match},
+            {'$sort': {'id': 1}},
+            {'$project': {'_id': 0}},
+            {'$lookup': {
+                'from': 'users',
+                'localField': 'contactId',
+                'foreignField': 'id',
+                'pipeline': [{'$project': USER_PROJECTION}],
+                'as': 'user',
+            }},
+            {'$unwind': '$user'},
+        ]
+    
+    def get_contacts_by_user_id(self, user_id: int) -> List[Dict[str, Any]]:
+        """Get contacts for user"""
+        return list(self.contacts_collection.aggregate(self._contact_pipeline({'userId': user_id})))
+    
+    def get_contact_by_user_and_contact_id(self, user_id: int, contact_id: int) -> Optional[Dict[str, Any]]:
+        """Get contact by user ID and contact ID"""
+        pipeline = self._contact_pipeline({'userId': user_id, 'contactId': contact_id})
+        return next(self.contacts_collection.aggregate(pipeline), None)
+    
+    def create_contact(self, contact_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create new contact"""
+        # Check if user and contact user exist in a single query
+        users = {
+            user['id']: user
+            for user in self.users_collection.find(
+                {'id': {'$in': [contact_data['userId'], contact_data['contactId']]}},
+                USER_PROJECTION
+            )
+        }
+        if contact_data['userId'] not in users:
+            raise ValueError(f"User with ID {contact_data['userId']} not found")
+        
+        contact_user = users.get(contact_data['contactId'])
+        if not contact_user:
+            raise ValueError(f"Contact user with ID {contact_data['contactId']} not found")
+        
+        # Create contact
+        contact = {
+            'id': self._get_next_sequence('contact_id'),
+            'userId': contact_data['userId'],
+            'contactId': contact_data['contactId'],
+            'displayName': contact_data.get('displayName', contact_user['displayName']),
+            'email': contact_data.get('email', None),
+            'phone': contact_data.get('phone', None),
+            'isBlocked': contact_data.get('isBlocked', False),
+            'isStarred': contact_data.get('isStarred', False),
+            'isArchived': contact_data.get('isArchived', False),
+            'isMuted': contact_data.get('isMuted', False),
+            'isScholar': contact_data.get('isScholar', False),
+            'notes': contact_data.get('notes', None),
+            'createdAt': int(time.time() * 1000),
+            'updatedAt': int(time.time() * 1000),
+        }
+        
+        # The unique (userId, contactId) index rejects duplicates
+        try:
+            self.contacts_collection.insert_one(contact)
+        except DuplicateKeyError:
+            raise ValueError(f"Contact already exists")
+        contact.pop('_id', None)
+        
+        # Merge contact and user details
+        return {**contact, 'user': contact_user}
+    
+    def _chat_pipeline(self, match: Dict[str, Any], user_id: int) -> List[Dict[str, Any]]:
+        """Aggregation pipeline returning a user's chats with participants,
+        latest message and unread count, starting from the chat_participants
+        collection so only chats the user belongs to are considered"""
+        return [
+            {'$match': match},
+            {'$sort': {'id': 1}},
+            {'$lookup': {
+                'from': 'chats',
+                'localField': 'chatId',
+                'foreignField': 'id',
+                'pipeline': [{'$project': {'_id': 0}}],
+                'as': 'chat',
+            }},
+            {'$unwind': '$chat'},
+            {'$lookup': {
+                'from': 'chat_participants',
+                'localField': 'chatId',
+                'foreignField': 'chatId',
+                'pipeline': self._participant_stages(),
+                'as': 'participants',
+            }},
+            {'$lookup': {
+                'from': 'messages',
+                'localField': 'chatId',
+                'foreignField': 'chatId',
+                'pipeline': [
+                    {'$sort': {'timestamp': -1, 'id': -1}},
+                    {'$limit': 1},
+                    {'$project': {'_id': 0}},
+                    *self._sender_stages(),
+                ],
+                'as': 'latestMessage',
+            }},
+            # Unread messages are the user's non-read statuses on other people's messages
+            {'$lookup': {
+                'from': 'message_statuses',
+                'let': {'chatId': '$chatId'},
+                'pipeline': [
+                    {'$match': {
+                        'userId': user_id,
+                        'status': {'$ne': 'read'},
+                        'senderId': {'$ne': user_id},
+                        '$expr': {'$eq': ['$chatId', '$$chatId']},
+                    }},
+                    {'$group': {'_id': None, 'count': {'$sum': 1}}},
+                ],
+                'as': 'unread',
+            }},
+            {'$replaceRoot': {'newRoot': {'$mergeObjects': [
+                '$chat',
+                {
+                    'participants': '$participants',
+                    'latestMessage': {'$ifNull': [{'$first': '$latestMessage'}, None]},
+                    'unreadCount': {'$ifNull': [{'$first': '$unread.count'}, 0]},
+                },
+            ]}}},
+        ]
+    
+    def _participant_stages(self) -> List[Dict[str, Any]]:
+        """Aggregation stages enriching chat participants with their user"""
+        return [
+            {'$sort': {'id': 1}},
+            {'$project': {'_id': 0}},
+            {'$lookup': {
+                'from': 'users',
+                'localField': 'userId',
+                'foreignField': 'id',
+                'pipeline': [{'$project': USER_PROJECTION}],
+                'as': 'user',
+            }},
+            {'$unwind': '$user'},
+        ]
+    
+    def _sender_stages(self, keep_missing: bool = False) -> List[Dict[str, Any]]:
+        """Aggregation stages enriching messages with their sender"""
+        return [
+            {'$lookup': {
+                'from': 'users',
+                'localField': 'senderId',
+                'foreignField': 'id',
+                'pipeline': [{'$project': USER_PROJECTION}],
+                'as': 'sender',
+            }},
+            {'$unwind': {'path': '$sender', 'preserveNullAndEmptyArrays': keep_missing}},
+        ]
+    
+    def get_chats_by_user_id(self, user_id: int) -> List[Dict[str, Any]]:
+        """Get chats for user"""
+        pipeline = self._chat_pipeline({'userId': user_id}, user_id)
+        return list(self.chat_participants_collection.aggregate(pipeline))
+    
+    def get_chat_ids_by_user_id(self, user_id: int) -> List[int]:
+        """Get the IDs of the chats a user participates in"""
+        return [
+            participant['chatId']
+            for participant in self.chat_participants_collection.find({'userId': user_id}, {'_id': 0, 'chatId': 1}).sort('id', 1)
+        ]
+    
+    def get_chat_by_id(self, chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get chat by ID"""
+        # Matching on the participant row also checks the user is in the chat
+        pipeline = self._chat_pipeline({'chatId': chat_id, 'userId': user_id}, user_id)
+        return next(self.chat_participants_collection.aggregate(pipeline), None)
+    
+    def get_direct_chat_ids(self, user_id: int, contact_ids: List[int]) -> Dict[int, int]:
+        """Get the IDs of the two-person chats between a user and each of the given contacts, keyed by contact"""
+        pipeline = [
+            {'$match': {'userId': user_id}},
+            {'$sort': {'id': 1}},
+            {'$lookup': {
+                'from': 'chat_participants',
+                'localField': 'chatId',
+                'foreignField': 'chatId',
+                'pipeline': [{'$project': {'_id': 0, 'userId': 1}}],
+                'as': 'participants',
+            }},
+            {'$match': {'participants': {'$size': 2}, 'participants.userId': {'$in': contact_ids}}},
+            {'$project': {'_id': 0, 'chatId': 1, 'participants': 1}},
+        ]
+        
+        chat_ids = {}
+        for chat in self.chat_participants_collection.aggregate(pipeline):
+            # Keep the first matching chat, as get_chat_by_participants does
+            for participant in chat['participants']:
+                if participant['userId'] != user_id:
+                    chat_ids.setdefault(participant['userId'], chat['chatId'])
+        
+        return chat_ids
+    
+    def get_chat_by_participants(self, participant_ids: List[int]) -> Optional[Dict[str, Any]]:
+        """Get chat by participant IDs"""
+        if not participant_ids:
+            return None
+        
+        # Find a chat containing all the participants and nobody else
+        pipeline = [
+            {'$match': {'userId': {'$in': participant_ids}}},
+            {'$group': {'_id': '$chatId', 'count': {'$sum': 1}}},
+            {'$match': {'count': len(participant_ids)}},
+            {'$lookup': {
+                'from': 'chat_participants',
+                'localField': '_id',
+                'foreignField': 'chatId',
+                'pipeline': [{'$count': 'count'}],
+                'as': 'all',
+            }},
+            {'$match': {'all.count': len(participant_ids)}},
+            {'$sort': {'_id': 1}},
+            {'$limit': 1},
+        ]
+        match = next(self.chat_participants_collection.aggregate(pipeline), None)
+        if not match:
+            return None
+        
+        return self.get_chat_by_id(match['_id'], participant_ids[0])
+    
+    def create_chat(self, chat_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create new chat"""
+        # Check that all participants exist in a single query
+        participants_data = chat_data.get('participants', [])
+        user_ids = [participant_data['userId'] for participant_data in participants_data]
+        users = {user['id']: user for user in self.users_collection.find({'id': {'$in': user_ids}}, USER_PROJECTION)}
+        for user_id in user_ids:
+            if user_id not in users:
+                raise ValueError(f"User with ID {user_id} not found")
+        
+        # Create chat
+        chat = {
+            'id': self._get_next_sequence('chat_id'),
+            'type': chat_data.get('type', 'personal'),  # personal, group
+            'name': chat_data.get('name', None),  # For group chats
+            'avatar': chat_data.get('avatar', None),  # For group chats
+            'description': chat_data.get('description', None),  # For group chats
+            'createdBy': chat_data.get('createdBy', None),  # For group chats
+            'isArchived': chat_data.get('isArchived', False),
+            'isMuted': chat_data.get('isMuted', False),
+            'createdAt': int(time.time() * 1000),
+            'updatedAt': int(time.time() * 1000),
+        }
+        self.chats_collection.insert_one(chat)
+        chat.pop('_id', None)
+        
+        # Add all participants in one batch
+        participants = [
+            {
+                'id': self._get_next_sequence('chat_participant_id'),
+                'chatId': chat['id'],
+                'userId': participant_data['userId'],
+                'role': participant_data.get('role', 'member'),  # admin, member
+                'joinedAt': int(time.time() * 1000),
+            }
+            for participant_data in participants_data
+        ]
+        if participants:
+            self.chat_participants_collection.insert_many(participants)
+        for participant in participants:
+            participant.pop('_id', None)
+            participant['user'] = users[participant['userId']]
+            self._notify_membership_changed(chat['id'], participant['userId'], True)
+        
+        # Enrich chat object
+        return {
+            **chat,
+            'participants': participants,
+            'latestMessage': None,
+            'unreadCount': 0,
+        }
+    
+    def get_chat_participants(self, chat_id: int) -> List[Dict[str, Any]]:
+        """Get participants for chat"""
+        pipeline = [{'$match': {'chatId': chat_id}}, *self._participant_stages()]
+        return list(self.chat_participants_collection.aggregate(pipeline))
+    
+    def add_chat_participant(self, participant_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Add participant to chat"""
+        # Check if chat exists
+        chat_id = participant_data['chatId']
+        if not self.chats_collection.find_one({'id': chat_id}, {'_id': 1}):
+            raise ValueError(f"Chat with ID {chat_id} not found")
+        
+        # Check if user exists
+        user_id = participant_data['userId']
+        user = self.users_collection.find_one({'id': user_id}, USER_PROJECTION)
+        if not user:
+            raise ValueError(f"User with ID {user_id} not found")
+        
+        # Create participant
+        participant = {
+            'id': self._get_next_sequence('chat_participant_id'),
+            'chatId': chat_id,
+            'userId': user_id,
+            'role': participant_data.get('role', 'member'),  # admin, member
+            'joinedAt': int(time.time() * 1000),
+        }
+        
+        # The unique (chatId, userId) index rejects existing participants
+        try:
+            self.chat_participants_collection.insert_one(participant)
+        except DuplicateKeyError:
+            raise ValueError(f"User with ID {user_id} is already a participant in chat with ID {chat_id}")
+        participant.pop('_id', None)
+        self._notify_membership_changed(chat_id, user_id, True)
+        
+        # Merge participant and user details
+        return {**participant, 'user': user}
+    
+    def remove_chat_participant(self, chat_id: int, user_id: int) -> None:
+        """Remove participant from chat"""
+        result = self.chat_participants_collection.delete_one({'chatId': chat_id, 'userId': user_id})
+        if not result.deleted_count:
+            raise ValueError(f"User with ID {user_id} is not a participant in chat with ID {chat_id}")
+        self._notify_membership_changed(chat_id, user_id, False)
+    
+    def is_chat_participant(self, chat_id: int, user_id: int) -> bool:
+        """Check if user is participant in chat"""
+        return self.chat_participants_collection.find_one({'chatId': chat_id, 'userId': user_id}, {'_id': 1}) is not None
+    
+    def get_chat_participant_ids(self, chat_id: int) -> List[int]:
+        """Get the user IDs of a chat's participants"""
+        return [
+            participant['userId']
+            for participant in self.chat_participants_collection.find({'chatId': chat_id}, {'_id': 0, 'userId': 1}).sort('id', 1)
+        ]
+    
+    def get_messages_by_chat_id(self, chat_id: int) -> List[Dict[str, Any]]:
+        """Get messages for chat"""
+        pipeline = [
+            {'$match': {'chatId': chat_id}},
+            {'$sort': {'timestamp': 1, 'id': 1}},
+            {'$project': {'_id': 0}},
+            *self._sender_stages(),
+        ]
+        return list(self.messages_collection.aggregate(pipeline))
+    
+    def get_messages_page(self, chat_id: int, before: Optional[int] = None, after: Optional[int] = None,
+                          limit: int = DEFAULT_MESSAGE_PAGE_SIZE) -> Dict[str, Any]:
+        """Get a page of chat messages before or after a cursor message ID"""
+        if before is not None and after is not None:
+            raise ValueError("Only one of 'before' and 'after' can be given")
+        limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+        
+        # Build a range query on (timestamp, id) relative to the cursor message
+        query = {'chatId': chat_id}
+        cursor = before if before is not None else after
+        if cursor is not None:
+            cursor_message = self.messages_collection.find_one({'id': cursor, 'chatId': chat_id})
+            if not cursor_message:
+                raise ValueError(f"Message with ID {cursor} not found in chat with ID {chat_id}")
+            op = '$lt' if before is not None else '$gt'
+            query['$or'] = [
+                {'timestamp': {op: cursor_message['timestamp']}},
+                {'timestamp': cursor_message['timestamp'], 'id': {op: cursor}},
+            ]
+        
+        # Fetch one extra message to know whether there is another page
+        direction = 1 if after is not None else -1
+        pipeline = [
+            {'$match': query},
+            {'$sort': {'timestamp': direction, 'id': direction}},
+            {'$limit': limit + 1},
+            {'$project': {'_id': 0}},
+            *self._sender_stages(keep_missing=True),
+        ]
+        messages = list(self.messages_collection.aggregate(pipeline))
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if direction == -1:
+            messages.reverse()
+        
+        next_cursor = None
+        if has_more and messages:
+            next_cursor = messages[-1]['id'] if after is not None else messages[0]['id']
+        
+        return {
+            'messages': [message for message in messages if message.get('sender')],
+            'nextCursor': next_cursor,
+        }
+    
+    def get_recent_messages_by_chat_ids(self, chat_ids: List[int], limit: int = 5) -> Dict[int, List[Dict[str, Any]]]:
+        """Get the latest messages of several chats, oldest first, keyed by chat"""
+        if not chat_ids:
+            return {}
+        
+        # One indexed branch per chat, combined into a single round trip
+        def latest(chat_id: int) -> List[Dict[str, Any]]:
+            return [
+                {'$match': {'chatId': chat_id}},
+                {'$sort': {'timestamp': -1, 'id': -1}},
+                {'$limit': limit},
+            ]
+        
+        pipeline = [
+            *latest(chat_ids[0]),
+            *({'$unionWith': {'coll': 'messages', 'pipeline': latest(chat_id)}} for chat_id in chat_ids[1:]),
+            {'$project': {'_id': 0}},
+            *self._sender_stages(keep_missing=True),
+        ]
+        
+        recent = {chat_id: [] for chat_id in chat_ids}
+        for message in self.messages_collection.aggregate(pipeline):
+            if message.get('sender'):
+                recent[message['chatId']].append(message)
+        for messages in recent.values():
+            messages.sort(key=lambda message: (message['timestamp'], message['id']))
+        
+        return recent
+    
+    def get_message(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """Get message by ID"""
+        pipeline = [
+            {'$match': {'id': to_id(message_id, 'message ID')}},
+            {'$project': {'_id': 0}},
+            *self._sender_stages(),
+        ]
+        return next(self.messages_collection.aggregate(pipeline), None)
+    
+    def _new_message(self, message_data: Dict[str, Any]) -> tuple:
+        """Validate a new message and build its document, returning (message, sender)"""
+        chat_id = message_data['chatId']
+        sender_id = message_data['senderId']
+        
+        # Check if sender exists
+        sender = self.users_collection.find_one({'id': sender_id}, USER_PROJECTION)
+        if not sender:
+            raise ValueError(f"User with ID {sender_id} not found")
+        
+        # Check if sender is a participant, which also implies the chat exists
+        if not self.is_chat_participant(chat_id, sender_id):
+            if not self.chats_collection.find_one({'id': chat_id}, {'_id': 1}):
+                raise ValueError(f"Chat with ID {chat_id} not found")
+            raise ValueError(f"User with ID {sender_id} is not a participant in chat with ID {chat_id}")
+        
+        # Create message
+        message = {
+            'id': self._get_next_sequence('message_id'),
+            'chatId': chat_id,
+            'senderId': sender_id,
+            'content': message_data['content'],
+            'type': message_data.get('type', 'text'),  # text, image, video, audio, file
+            'quotedMessageId': message_data.get('quotedMessageId', None),
+            'timestamp': message_data.get('timestamp', int(time.time() * 1000)),
+            'status': message_data.get('status', 'sent'),  # sent, delivered, read
+        }
+        return message, sender
+    
+    def create_message(self, message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create new message"""
+        message, sender = self._new_message(message_data)
+        self.messages_collection.insert_one(message)
+        message.pop('_id', None)
+        
+        # Update chat's updatedAt timestamp
+        self.chats_collection.update_one({'id': message['chatId']}, {'$set': {'updatedAt': int(time.time() * 1000)}})
+        
+        # Enrich message object
+        return {**message, 'sender': sender}
+    
+    def create_message_with_statuses(self, message_data: Dict[str, Any], participant_ids: List[int]) -> Dict[str, Any]:
+        """Create a message and its statuses for all participants in one atomic write"""
+        message, sender = self._new_message(message_data)
+        
+        # Create statuses: 'sent' for the sender, 'delivered' for everyone else
+        statuses = [
+            {
+                'id': self._get_next_sequence('message_status_id'),
+                'messageId': message['id'],
+                'userId': user_id,
+                'status': 'sent' if user_id == message['senderId'] else 'delivered',
+                'timestamp': message['timestamp'],
+                'chatId': message['chatId'],
+                'senderId': message['senderId'],
+            }
+            for user_id in dict.fromkeys(participant_ids)
+        ]
+        
+        if self.supports_transactions:
+            with self.client.start_session() as session:
+                session.with_transaction(lambda session: self._insert_message_with_statuses(message, statuses, session))
+        else:
+            # Without transactions, undo the message if its statuses can't be
+            # written, so a message never exists without them
+            try:
+                self._insert_message_with_statuses(message, statuses)
+            except Exception:
+                self.message_statuses_collection.delete_many({'messageId': message['id']})
+                self.messages_collection.delete_one({'id': message['id']})
+                raise
+        
+        # Enrich message object
+        return {**message, 'sender': sender}
+    
+    def _insert_message_with_statuses(self, message: Dict[str, Any], statuses: List[Dict[str, Any]], session=None) -> None:
+        """Insert a message and its statuses, inside a transaction if a session is given"""
+        # Insert copies, since a retried transaction runs this again with the same documents
+        self.messages_collection.insert_one(dict(message), session=session)
+        if statuses:
+            self.message_statuses_collection.insert_many([dict(status) for status in statuses], ordered=False, session=session)
+        
+        # Update chat's updatedAt timestamp
+        self.chats_collection.update_one(
+            {'id': message['chatId']}, {'$set': {'updatedAt': int(time.time() * 1000)}}, session=session
+        )
+    
+    def get_message_status_by_message_and_user_id(self, message_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get message status by message ID and user ID"""
+        query = {'messageId': to_id(message_id, 'message ID'), 'userId': to_id(user_id, 'user ID')}
+        return self.message_statuses_collection.find_one(query, STATUS_PROJECTION)
+    
+    def create_message_status(self, status_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create message status"""
+        # Check if message exists
+        message_id = status_data['messageId']
+        message = self.messages_collection.find_one({'id': message_id}, {'_id': 0, 'chatId': 1, 'senderId': 1})
+        if not message:
+            raise ValueError(f"Message with ID {message_id} not found")
+        
+        # Check if user exists
+        user_id = status_data['userId']
+        if not self.users_collection.find_one({'id': user_id}, {'_id': 1}):
+            raise ValueError(f"User with ID {user_id} not found")
+        
+        # Create status
+        status = {
+            'id': self._get_next_sequence('message_status_id'),
+            'messageId': message_id,
+            'userId': user_id,
+            'status': status_data['status'],  # sent, delivered, read
+            'timestamp': status_data.get('timestamp', int(time.time() * 1000)),
+        }
+        
+        # Denormalize the chat and sender so unread counts can be grouped per chat
+        document = {**status, 'chatId': message['chatId'], 'senderId': message['senderId']}
+        try:
+            self.message_statuses_collection.insert_one(document)
+        except DuplicateKeyError:
+            raise ValueError(f"Status already exists for message with ID {message_id} and user with ID {user_id}")
+        
+        return status
+    
+    def update_message_status(self, message_id: int, user_id: int, status: str) -> Optional[Dict[str, Any]]:
+        """Update message status, returning None for an unknown status name"""
+        # Reject unknown statuses, as in-memory storage can't hold them, and malformed IDs
+        if status not in STATUS_CODES:
+            return None
+        message_id, user_id = to_id(message_id, 'message ID'), to_id(user_id, 'user ID')
+        
+        updated_status = self.message_statuses_collection.find_one_and_update(
+            {'messageId': message_id, 'userId': user_id},
+            {'$set': {'status': status, 'timestamp': int(time.time() * 1000)}},
+            projection=STATUS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if not updated_status:
+            raise ValueError(f"Status not found for message with ID {message_id} and user with ID {user_id}")
+        
+        # Update message status if all participants have read
+        if status == 'read':
+            self._update_message_status_if_all(message_id)
+        
+        return updated_status
+    
+    def mark_messages_read_up_to(self, chat_id: int, user_id: int, message_id: Optional[int] = None,
+                                 timestamp: Optional[int] = None) -> List[int]:
+        """Mark a user's unread messages in a chat as read in one batch"""
+        if message_id is None and timestamp is None:
+            raise ValueError("Either a message ID or a timestamp is required")
+        if message_id is not None:
+            message_id = to_id(message_id, 'message ID')
+        
+        # Bound the range by the cursor message's (timestamp, id) or by timestamp
+        if message_id is not None:
+            message = self.messages_collection.find_one({'id': message_id, 'chatId': chat_id})
+            if not message:
+                raise ValueError(f"Message with ID {message_id} not found in chat with ID {chat_id}")
+            bound = {'$or': [
+                {'timestamp': {'$lt': message['timestamp']}},
+                {'timestamp': message['timestamp'], 'id': {'$lte': message_id}},
+            ]}
+        else:
+            bound = {'timestamp': {'$lte': timestamp}}
+        
+        # Unread statuses are few, so narrow them down to the range's messages
+        unread_message_ids = [
+            status['messageId']
+            for status in self.message_statuses_collection.find(
+                {'chatId': chat_id, 'userId': user_id, 'status': {'$ne': 'read'}, 'senderId': {'$ne': user_id}},
+                {'_id': 0, 'messageId': 1}
+            )
+        ]
+        if not unread_message_ids:
+            return []
+        read_messages = list(
+            self.messages_collection.find({'id': {'$in': unread_message_ids}, **bound}, {'_id': 0, 'id': 1, 'senderId': 1})
+            .sort([('timestamp', 1), ('id', 1)])
+        )
+        read_message_ids = [message['id'] for message in read_messages]
+        if not read_message_ids:
+            return []
+        
+        # Mark all of them read in one update
+        self.message_statuses_collection.update_many(
+            {'messageId': {'$in': read_message_ids}, 'userId': user_id},
+            {'$set': {'status': 'read', 'timestamp': int(time.time() * 1000)}}
+        )
+        
+        # Messages are fully read once every participant but the sender has read them
+        participant_count = self.chat_participants_collection.count_documents({'chatId': chat_id})
+        read_counts = self.message_statuses_collection.aggregate([
+            {'$match': {'messageId': {'$in': read_message_ids}, 'status': 'read'}},
+            {'$match': {'$expr': {'$ne': ['$userId', '$senderId']}}},
+            {'$group': {'_id': '$messageId', 'count': {'$sum': 1}}},
+        ])
+        all_read_ids = [count['_id'] for count in read_counts if count['count'] >= participant_count - 1]
+        if all_read_ids:
+            self.messages_collection.update_many({'id': {'$in': all_read_ids}}, {'$set': {'status': 'read'}})
+        
+        return read_message_ids
+    
+    def _update_message_status_if_all(self, message_id: int) -> None:
+        """Update message status if all participants have read the message"""
+        message = self.messages_collection.find_one({'id': message_id}, {'_id': 0, 'chatId': 1, 'senderId': 1})
+        if not message:
+            return
+        
+        # Every participant except the sender needs a 'read' status
+        recipients = self.chat_participants_collection.count_documents(
+            {'chatId': message['chatId'], 'userId': {'$ne': message['senderId']}}
+        )
+        read = self.message_statuses_collection.count_documents(
+            {'messageId': message_id, 'userId': {'$ne': message['senderId']}, 'status': 'read'}
+        )
+        if read >= recipients:
+            self.messages_collection.update_one({'id': message_id}, {'$set': {'status': 'read'}})
+    
+    def _seed(self, seed_mode: str) -> None:
+        """Seed an empty database with demo data"""
+        if seed_mode == 'none':
+            return
+        
+        if seed_mode == 'fixture':
+            print("Seeding demo data from fixture...")
+            fixture = load_demo_fixture()
+            for collection, records in fixture.items():
+                if collection != 'counters' and records:
+                    self.db[collection].insert_many(list(records.values()))
+            
+            # Move the counters past the fixture's IDs
+            for name, seq in fixture.get('counters', {}).items():
+                self.counters_collection.update_one({'_id': name}, {'$max': {'seq': seq}}, upsert=True)
+            return
+        
+        print("Initializing demo data...")
+        self._initialize_demo_data()
+    
     def _initialize_demo_data(self):
         """Initialize demo data for testing"""
         # Create a demo user
@@ -1084,6 +2813,9 @@ def get_storage() -> Storage:
             return mongo_storage
         except Exception as e:
             print(f"Error initializing MongoDB storage: {e}")
+            # Worker processes share one data directory, so they must not fall back to it
+            if os.getenv('STORAGE_FALLBACK', 'true').lower() != 'true':
+                raise RuntimeError("MongoDB storage is required and in-memory fallback is disabled") from e
             print("Falling back to in-memory storage")
     else:
         print("Using in-memory storage for now")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Chat membership cache for authorizing high-frequency socket events."""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any
+
+class MembershipCache:
+    """Bounded LRU cache of chat membership checks in front of the storage layer.
+    
+    Only positive answers are cached: the storage's membership listeners
+    only fire for changes made in this process, so a cached "no" would keep
+    rejecting a user added through another worker. Entries are invalidated
+    by those listeners and expire after ttl seconds, which bounds how long a
+    removal made elsewhere goes unnoticed.
+    """
+    
+    def __init__(self, storage, max_size: int = None, ttl: float = None):
+        """Initialize the cache and subscribe to membership changes"""
+        self.storage = storage
+        self.max_size = max_size or int(os.getenv('MEMBERSHIP_CACHE_SIZE', 10000))
+        self.ttl = ttl or float(os.getenv('MEMBERSHIP_CACHE_TTL', 60))
+        self._entries = OrderedDict()  # (chatId, userId) -> expiry time of a confirmed membership
+        self._lock = threading.Lock()
+        self._generation = 0  # Bumped on invalidation so in-flight misses don't cache stale answers
+        self.hits = 0
+        self.misses = 0
+        
+        storage.add_membership_listener(self._handle_membership_changed)
+    
+    def is_chat_participant(self, chat_id: int, user_id: int) -> bool:
+        """Check if user is participant in chat, consulting storage only on a miss"""
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self._entries.pop(key, None)
+            self.misses += 1
+            generation = self._generation
+        
+        if not self.storage.is_chat_participant(chat_id, user_id):
+            return False
+        
+        with self._lock:
+            if generation != self._generation:
+                return True
+            self._entries[key] = now + self.ttl
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        
+        return True
+    
+    def invalidate(self, chat_id: int, user_id: int) -> None:
+        """Drop the cached membership of a user in a chat"""
+        with self._lock:
+            self._entries.pop((chat_id, user_id), None)
+            self._generation += 1
+    
+    def clear(self) -> None:
+        """Drop all cached memberships"""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache size and hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxSize': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+        }
+    
+    def _handle_membership_changed(self, chat_id: int, user_id: int, is_member: bool) -> None:
+        """Storage listener invalidating a changed membership"""
+        self.invalidate(chat_id, user_id)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Socket.IO message queue configuration for the WhatsApp clone application.
+
+The local:// loopback queue is for running several socketio.Server instances
+in one process. Flask-SocketIO's test client refuses to work with a message
+queue, so exercise it through raw python-socketio servers instead.
+"""
+import json
+import os
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import socketio
+
+LOCAL_SCHEME = 'local'
+DEFAULT_CHANNEL = 'flask-socketio'
+
+class LocalPubSubManager(socketio.PubSubManager):
+    """In-process message queue so several servers in one process share broadcasts,
+    usable from raw python-socketio servers but not Flask-SocketIO's test client"""
+    
+    name = LOCAL_SCHEME
+    
+    # Subscriber queues shared by every manager in this process, keyed by channel
+    _subscribers: Dict[str, List[queue.Queue]] = {}
+    _subscribers_lock = threading.Lock()
+    
+    def __init__(self, url: str = 'local://', channel: Optional[str] = None,
+                 write_only: bool = False, logger=None, json=None):
+        """Initialize the manager, taking the channel from the URL host if given"""
+        channel = channel or urlparse(url).netloc or DEFAULT_CHANNEL
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self._queue: queue.Queue = queue.Queue()
+        if not write_only:
+            with self._subscribers_lock:
+                self._subscribers.setdefault(self.channel, []).append(self._queue)
+    
+    def _publish(self, data: Dict[str, Any]) -> None:
+        """Deliver a serialized copy of the message to every subscriber on the channel"""
+        payload = json.dumps(data)
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers.get(self.channel, []))
+        for subscriber in subscribers:
+            subscriber.put(payload)
+    
+    def _listen(self):
+        """Yield messages published on the channel, including this manager's own"""
+        while True:
+            yield self._queue.get()
+    
+    def close(self) -> None:
+        """Stop receiving messages from the channel"""
+        with self._subscribers_lock:
+            subscribers = self._subscribers.get(self.channel, [])
+            if self._queue in subscribers:
+                subscribers.remove(self._queue)
+
+def get_socketio_options(url: Optional[str] = None) -> Dict[str, Any]:
+    """Get SocketIO keyword arguments for the configured message queue"""
+    url = url if url is not None else os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+    channel = os.getenv('SOCKETIO_CHANNEL', DEFAULT_CHANNEL)
+    
+    if not url:
+        print("Socket.IO broadcasts limited to this process")
+        return {}
+    
+    # The loopback queue is built here, brokers are built by Flask-SocketIO
+    scheme = urlparse(url).scheme
+    if scheme == LOCAL_SCHEME:
+        channel = urlparse(url).netloc or channel
+        print(f"Using local Socket.IO message queue on channel '{channel}'")
+        return {'client_manager': LocalPubSubManager(url, channel=channel)}
+    
+    print(f"Using Socket.IO message queue at {scheme}://")
+    return {'message_queue': url, 'channel': channel}
\ No newline at end of file
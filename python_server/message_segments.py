@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Segmented on-disk message store for the WhatsApp clone application."""
+import json
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from records import Message
+
+SEGMENT_FILE_PATTERN = re.compile(r'^segment-(\d+)\.index\.json$')
+
+class SegmentIndex:
+    """Chat, sender and timestamp of every message slot in one segment"""
+    
+    __slots__ = ('chat_ids', 'sender_ids', 'timestamps', 'count')
+    
+    def __init__(self, size: int):
+        """Initialize an empty index, where chat ID 0 marks a free slot"""
+        self.chat_ids = array('q', bytes(8 * size))
+        self.sender_ids = array('q', bytes(8 * size))
+        self.timestamps = array('q', bytes(8 * size))
+        self.count = 0
+
+class SegmentedMessageStore(MutableMapping):
+    """Dict-like store of Message records by ID, split into segment files by ID range.
+    
+    Message IDs are allocated in order, so each block of segment_size IDs
+    holds the messages of one window of time. Only a small index of each
+    message's chat, sender and timestamp is kept for every segment; message
+    bodies are loaded a segment at a time on first access, and the least
+    recently used clean segments are dropped beyond max_resident. Segments
+    with unsaved changes stay resident until they are written.
+    """
+    
+    def __init__(self, directory: str, segment_size: Optional[int] = None,
+                 max_resident: Optional[int] = None):
+        """Initialize the store, reading unset options from the environment"""
+        self.directory = directory
+        self.segment_size = segment_size or int(os.getenv('STORAGE_SEGMENT_SIZE', 1000))
+        self.max_resident = max_resident or int(os.getenv('STORAGE_RESIDENT_SEGMENTS', 16))
+        self._indexes: Dict[int, SegmentIndex] = {}
+        self._resident = OrderedDict()  # segment -> {message ID: message}, least recently used first
+        self._dirty = set()  # segments changed since they were last captured for writing
+        self._writing = set()  # segments captured for writing but not yet written
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+    
+    def load(self) -> None:
+        """Read the index of every segment on disk, leaving the bodies for later"""
+        with self._lock:
+            self._indexes = {}
+            self._resident.clear()
+            self._dirty.clear()
+            for name in os.listdir(self.directory):
+                match = SEGMENT_FILE_PATTERN.match(name)
+                if not match:
+                    continue
+                
+                with open(os.path.join(self.directory, name), 'r') as f:
+                    data = json.load(f)
+                index = SegmentIndex(self.segment_size)
+                for message_id, chat_id, sender_id, timestamp in data['messages']:
+                    offset = self._offset(message_id)
+                    index.chat_ids[offset] = chat_id
+                    index.sender_ids[offset] = sender_id
+                    index.timestamps[offset] = timestamp
+                    index.count += 1
+                self._indexes[int(match.group(1))] = index
+    
+    def _segment(self, message_id: int) -> int:
+        """Get the segment holding a message ID"""
+        return (message_id - 1) // self.segment_size
+    
+    def _offset(self, message_id: int) -> int:
+        """Get a message ID's slot within its segment"""
+        return (message_id - 1) % self.segment_size
+    
+    def _segment_path(self, segment: int, kind: str) -> str:
+        """Get the path of a segment's message or index file"""
+        return os.path.join(self.directory, f"segment-{segment:06d}.{kind}.json")
+    
+    def _resident_segment(self, segment: int) -> Dict[int, Message]:
+        """Get a segment's messages, loading them from disk if they are not resident"""
+        messages = self._resident.get(segment)
+        if messages is not None:
+            self._resident.move_to_end(segment)
+            return messages
+        
+        messages = {}
+        path = self._segment_path(segment, 'messages')
+        if segment in self._indexes and os.path.exists(path):
+            with open(path, 'r') as f:
+                messages = {int(key): Message.from_dict(value) for key, value in json.load(f).items()}
+            self.loads += 1
+        self._resident[segment] = messages
+        
+        # Drop the least recently used segments that have nothing left to write
+        excess = len(self._resident) - self.max_resident
+        for evicted in list(self._resident):
+            if excess <= 0:
+                break
+            if evicted == segment or evicted in self._dirty or evicted in self._writing:
+                continue
+            del self._resident[evicted]
+            self.evictions += 1
+            excess -= 1
+        
+        return messages
+    
+    def __getitem__(self, message_id: int) -> Message:
+        """Get a message by ID"""
+        with self._lock:
+            if self.meta(message_id) is None:
+                raise KeyError(message_id)
+            return self._resident_segment(self._segment(message_id))[message_id]
+    
+    def __setitem__(self, message_id: int, message: Message) -> None:
+        """Add or replace a message, marking its segment for writing"""
+        segment = self._segment(message_id)
+        offset = self._offset(message_id)
+        with self._lock:
+            messages = self._resident_segment(segment)
+            index = self._indexes.setdefault(segment, SegmentIndex(self.segment_size))
+            if message_id not in messages:
+                index.count += 1
+            messages[message_id] = message
+            index.chat_ids[offset] = message.chat_id
+            index.sender_ids[offset] = message.sender_id
+            index.timestamps[offset] = message.timestamp
+            self._dirty.add(segment)
+    
+    def __delitem__(self, message_id: int) -> None:
+        """Remove a message, marking its segment for writing"""
+        segment = self._segment(message_id)
+        with self._lock:
+            if self.meta(message_id) is None:
+                raise KeyError(message_id)
+            del self._resident_segment(segment)[message_id]
+            index = self._indexes[segment]
+            index.chat_ids[self._offset(message_id)] = 0
+            index.count -= 1
+            self._dirty.add(segment)
+    
+    def __contains__(self, message_id: object) -> bool:
+        """Check if a message exists without loading its segment"""
+        return isinstance(message_id, int) and self.meta(message_id) is not None
+    
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over message IDs without loading any segment"""
+        for message_id, chat_id, sender_id, timestamp in self.iter_meta():
+            yield message_id
+    
+    def __len__(self) -> int:
+        """Count stored messages"""
+        with self._lock:
+            return sum(index.count for index in self._indexes.values())
+    
+    def meta(self, message_id: int) -> Optional[Tuple[int, int, int]]:
+        """Get a message's (chatId, senderId, timestamp) from the index, or None if it doesn't exist"""
+        if message_id < 1:
+            return None
+        index = self._indexes.get(self._segment(message_id))
+        if index is None:
+            return None
+        offset = self._offset(message_id)
+        if not index.chat_ids[offset]:
+            return None
+        return index.chat_ids[offset], index.sender_ids[offset], index.timestamps[offset]
+    
+    def iter_meta(self) -> Iterator[Tuple[int, int, int, int]]:
+        """Iterate over (id, chatId, senderId, timestamp) of every message from the index"""
+        with self._lock:
+            segments = sorted(self._indexes.items())
+        for segment, index in segments:
+            first_id = segment * self.segment_size + 1
+            for offset, chat_id in enumerate(index.chat_ids):
+                if chat_id:
+                    yield first_id + offset, chat_id, index.sender_ids[offset], index.timestamps[offset]
+    
+    def snapshot(self) -> Dict[int, Dict[int, Message]]:
+        """Capture copies of the segments changed since the last capture, for write_snapshot"""
+        with self._lock:
+            segments = sorted(self._dirty)
+            self._dirty.clear()
+            self._writing.update(segments)
+            return {segment: dict(self._resident[segment]) for segment in segments}
+    
+    def write_snapshot(self, snapshot: Dict[int, Dict[int, Message]],
+                       write_json_file: Callable[[str, Any], None]) -> None:
+        """Write captured segments, each message file before its index"""
+        try:
+            for segment, messages in snapshot.items():
+                write_json_file(self._segment_path(segment, 'messages'), {
+                    str(message_id): message.to_dict() for message_id, message in messages.items()
+                })
+                write_json_file(self._segment_path(segment, 'index'), {
+                    'messages': [
+                        [message.id, message.chat_id, message.sender_id, message.timestamp]
+                        for message in messages.values()
+                    ],
+                })
+        except Exception:
+            # Keep failed segments resident so the next write retries them
+            with self._lock:
+                self._dirty.update(snapshot)
+            raise
+        finally:
+            with self._lock:
+                self._writing.difference_update(snapshot)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get segment counts and load/eviction counters"""
+        with self._lock:
+            return {
+                'segments': len(self._indexes),
+                'resident': len(self._resident),
+                'maxResident': self.max_resident,
+                'dirty': len(self._dirty),
+                'segmentSize': self.segment_size,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
@@ -3,15 +3,32 @@
 import os
 import json
 import time
-from typing import Dict, List, Any, Optional
-import openai
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError, wait
+from typing import Dict, List, Any, Optional, Callable, Iterator, Tuple
 from dotenv import load_dotenv
+from starter_cache import StarterCache
 
 # Load environment variables
 load_dotenv()
 
-# Set up OpenAI API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Upper bound on a single OpenAI request, in seconds
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 30))
+
+# The OpenAI client is imported on first use, since importing it dominates startup time
+_openai = None
+
+def get_openai():
+    """Import and configure the OpenAI module on first use"""
+    global _openai
+    if _openai is None:
+        import openai
+        
+        # Set up OpenAI API key
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        _openai = openai
+    
+    return _openai
 
 class ConversationContext:
     """Class to store conversation context for OpenAI API"""
@@ -21,6 +38,21 @@ class ConversationContext:
         self.user = user
         self.contact = contact
         self.recent_messages = recent_messages or []
+    
+    @classmethod
+    def for_contact(cls, user: Dict[str, Any], contact: Dict[str, Any], contact_user: Dict[str, Any],
+                    recent_messages: Optional[List[Dict[str, Any]]] = None) -> 'ConversationContext':
+        """Build the context for a user's contact from the contact record and the contact's user"""
+        return cls(
+            user=user,
+            contact={
+                'id': contact['contactId'],
+                'displayName': contact['displayName'],
+                'status': contact_user.get('status', ''),
+                'isScholar': contact.get('isScholar', False),
+            },
+            recent_messages=recent_messages
+        )
 
 class ConversationStarter:
     """Class to store conversation starter data"""
@@ -37,50 +69,209 @@ class ConversationStarter:
             'category': self.category
         }
 
+def request_conversation_starters(context: ConversationContext, client=None,
+                                  timeout: float = OPENAI_TIMEOUT) -> List[Dict[str, str]]:
+    """Request conversation starters from OpenAI, or an injected client with the same API, raising if none are returned"""
+    # Build prompt based on available context
+    prompt = build_prompt(context)
+    
+    # Call OpenAI API
+    response = (client or get_openai()).chat.completions.create(
+        model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You are a helpful assistant that generates conversation starters based on context. "
+                    "Generate a list of 5 conversation starters that a user could use to start a conversation with another person. "
+                    "Each starter should be categorized as one of: greeting, question, religious, general. "
+                    "Respond with a JSON array where each object has 'text' and 'category' fields."
+                )
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        response_format={"type": "json_object"},
+        timeout=timeout
+    )
+    
+    # Parse response
+    result = json.loads(response.choices[0].message.content)
+    
+    # Extract conversation starters
+    starters = result.get('starters', [])
+    
+    # Validate and return starters
+    if not starters or len(starters) == 0:
+        raise ValueError("OpenAI returned no conversation starters")
+    
+    return starters
+
 def generate_conversation_starters(context: ConversationContext) -> List[Dict[str, str]]:
-    """Generate conversation starters based on context"""
+    """Generate conversation starters based on context, without caching or a deadline.
+    
+    Routes use StarterGenerator, which adds both.
+    """
     try:
-        # Build prompt based on available context
-        prompt = build_prompt(context)
+        return request_conversation_starters(context)
+    except Exception as e:
+        print(f"Error generating conversation starters: {e}")
+        # Fallback to default starters
+        return get_default_starters(context)
+
+class StarterGenerator:
+    """Generates conversation starters on a background executor with a hard deadline.
+    
+    Requests wait at most `deadline` seconds. Past that they get the default
+    starters, and the real result is handed to a callback once it arrives.
+    Concurrent requests for the same context share one upstream call.
+    """
+    
+    def __init__(self, client=None, cache: Optional[StarterCache] = None, deadline: float = None,
+                 max_workers: int = None):
+        """Initialize the generator; client defaults to the openai module"""
+        self.client = client
+        self.cache = cache
+        self.deadline = deadline if deadline is not None else float(os.getenv('STARTER_DEADLINE', 3))
+        self.max_workers = max_workers or int(os.getenv('STARTER_WORKERS', 4))
+        self.batch_concurrency = int(os.getenv('STARTER_BATCH_CONCURRENCY', self.max_workers))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='starters')
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}  # context fingerprint -> pending generation
+        self.timeouts = 0
+        self.failures = 0
+    
+    def generate(self, context: ConversationContext,
+                 on_ready: Optional[Callable[[List[Dict[str, str]]], None]] = None) -> Tuple[List[Dict[str, str]], bool]:
+        """Get starters within the deadline as (starters, pending).
         
-        # Call OpenAI API
-        response = openai.chat.completions.create(
-            model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a helpful assistant that generates conversation starters based on context. "
-                        "Generate a list of 5 conversation starters that a user could use to start a conversation with another person. "
-                        "Each starter should be categorized as one of: greeting, question, religious, general. "
-                        "Respond with a JSON array where each object has 'text' and 'category' fields."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            response_format={"type": "json_object"}
-        )
+        When pending is True the defaults were returned, and on_ready is
+        called with the generated starters once they are ready.
+        """
+        key = StarterCache.fingerprint(context)
+        if self.cache:
+            starters = self.cache.get(key)
+            if starters is not None:
+                return starters, False
+        
+        future = self._submit(key, context)
+        try:
+            return future.result(timeout=self.deadline), False
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            if on_ready:
+                future.add_done_callback(lambda done: self._deliver(done, on_ready))
+            return get_default_starters(context), True
+        except Exception:
+            return get_default_starters(context), False
+    
+    def generate_many(self, contexts: Dict[Any, ConversationContext]) -> Iterator[Tuple[Any, List[Dict[str, str]]]]:
+        """Yield (item, starters) for many contexts as each becomes ready.
         
-        # Parse response
-        result = json.loads(response.choices[0].message.content)
+        Cached results come first. Identical contexts share one upstream call,
+        and at most batch_concurrency calls from the batch run at once. Failed
+        generations yield the default starters.
+        """
+        # Group the items by fingerprint, answering cached ones straight away
+        groups: Dict[str, Tuple[ConversationContext, List[Any]]] = {}
+        for item, context in contexts.items():
+            key = StarterCache.fingerprint(context)
+            if key in groups:
+                groups[key][1].append(item)
+                continue
+            
+            starters = self.cache.get(key) if self.cache else None
+            if starters is not None:
+                yield item, starters
+                continue
+            groups[key] = (context, [item])
+        
+        # Keep a bounded number of upstream calls running, yielding each as it finishes
+        queued = list(groups)
+        running: Dict[Future, str] = {}
+        while queued or running:
+            while queued and len(running) < self.batch_concurrency:
+                key = queued.pop(0)
+                running[self._submit(key, groups[key][0])] = key
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                context, items = groups[running.pop(future)]
+                try:
+                    starters = future.result()
+                except Exception:
+                    starters = get_default_starters(context)
+                for item in items:
+                    yield item, starters
+    
+    def prefetch(self, context: ConversationContext) -> bool:
+        """Start generating uncached starters in the background without waiting.
         
-        # Extract conversation starters
-        starters = result.get('starters', [])
+        Returns False when the workers are already busy, so prefetching never
+        queues up ahead of interactive requests.
+        """
+        key = StarterCache.fingerprint(context)
+        if self.cache and self.cache.contains(key):
+            return True
         
-        # Validate and return starters
-        if not starters or len(starters) == 0:
-            # Fallback to default starters
-            return get_default_starters(context)
+        with self._lock:
+            if key not in self._in_flight and len(self._in_flight) >= self.max_workers:
+                return False
         
-        return starters
+        self._submit(key, context)
+        return True
     
-    except Exception as e:
-        print(f"Error generating conversation starters: {e}")
-        # Fallback to default starters
-        return get_default_starters(context)
+    def _submit(self, key: str, context: ConversationContext) -> Future:
+        """Start generating starters for a context unless that is already in progress"""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._executor.submit(self._run, key, context)
+                self._in_flight[key] = future
+            return future
+    
+    def _run(self, key: str, context: ConversationContext) -> List[Dict[str, str]]:
+        """Background task calling upstream and caching the result"""
+        try:
+            starters = request_conversation_starters(context, self.client)
+            if self.cache:
+                self.cache.put(key, starters)
+            return starters
+        except Exception as e:
+            print(f"Error generating conversation starters: {e}")
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+    
+    def _deliver(self, future: Future, on_ready: Callable[[List[Dict[str, str]]], None]) -> None:
+        """Hand a late result to its callback, unless generation failed"""
+        if future.cancelled() or future.exception():
+            return
+        
+        try:
+            on_ready(future.result())
+        except Exception as e:
+            print(f"Error delivering conversation starters: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get deadline settings and generation counters"""
+        with self._lock:
+            return {
+                'deadline': self.deadline,
+                'inFlight': len(self._in_flight),
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+            }
+    
+    def close(self) -> None:
+        """Stop the executor, abandoning queued generations"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
 def build_prompt(context: ConversationContext) -> str:
     """Build a detailed prompt based on available context"""
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Password hashing on a bounded worker pool for the WhatsApp clone application."""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import bcrypt
+
+DEFAULT_BCRYPT_ROUNDS = 12
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password operations are already waiting for the pool"""
+    pass
+
+def _hash_password(password: str, rounds: int) -> str:
+    """Hash a password with a fresh salt at the given cost"""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+def _check_password(password: str, password_hash: str) -> bool:
+    """Check a password against a stored hash"""
+    return bcrypt.checkpw(password.encode(), password_hash.encode())
+
+class PasswordHasher:
+    """Runs bcrypt on a process pool, rejecting work once the queue is full"""
+    
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 rounds: Optional[int] = None):
+        """Initialize the hasher, reading unset options from the environment"""
+        self.workers = workers if workers is not None else int(os.getenv('BCRYPT_WORKERS', os.cpu_count() or 1))
+        self.max_pending = max_pending if max_pending is not None else int(os.getenv('BCRYPT_MAX_PENDING', self.workers * 8))
+        self.rounds = rounds if rounds is not None else int(os.getenv('BCRYPT_ROUNDS', DEFAULT_BCRYPT_ROUNDS))
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+    
+    def start(self) -> None:
+        """Start the worker processes, ideally before the server starts any threads"""
+        if self.workers <= 0:
+            return
+        
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+            executor = self._executor
+        
+        # Forked pools launch every worker on the first submission
+        executor.submit(int).result()
+    
+    def hash(self, password: str) -> str:
+        """Hash a password at the configured cost"""
+        return self._run(_hash_password, password, self.rounds)
+    
+    def verify(self, password: str, password_hash: str) -> bool:
+        """Check a password against a stored hash"""
+        return self._run(_check_password, password, password_hash)
+    
+    def needs_rehash(self, password_hash: str) -> bool:
+        """Check whether a hash was made at a different cost than the configured one"""
+        # bcrypt hashes look like $2b$<rounds>$<salt and digest>
+        parts = password_hash.split('$')
+        return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != self.rounds
+    
+    def _run(self, func: Callable[..., Any], *args) -> Any:
+        """Run a function on the pool and wait for it, or inline when the pool is disabled"""
+        if self.workers <= 0:
+            return func(*args)
+        
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordHasherBusy("Too many password operations in progress")
+            self._pending += 1
+            if self._executor is None:
+                self._executor = self._create_executor()
+            executor = self._executor
+        
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+    
+    def _create_executor(self) -> Executor:
+        """Create the process pool, forking where the platform allows so workers skip re-importing the app"""
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(start_method))
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get pool configuration and current queue depth"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self._pending,
+                'maxPending': self.max_pending,
+                'rejected': self.rejected,
+                'rounds': self.rounds,
+            }
+    
+    def close(self) -> None:
+        """Shut down the process pool"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown()
\ No newline at end of file
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Compact in-memory record types for the WhatsApp clone application."""
+from typing import Any, Dict, Optional
+
+class Message:
+    """A chat message, stored with slots instead of a per-record dict"""
+    
+    __slots__ = ('id', 'chat_id', 'sender_id', 'content', 'type', 'quoted_message_id', 'timestamp', 'status')
+    
+    def __init__(self, id: int, chat_id: int, sender_id: int, content: str, type: str = 'text',
+                 quoted_message_id: Optional[int] = None, timestamp: int = 0, status: str = 'sent'):
+        """Initialize a message"""
+        self.id = id
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.content = content
+        self.type = type  # text, image, video, audio, file
+        self.quoted_message_id = quoted_message_id
+        self.timestamp = timestamp
+        self.status = status  # sent, delivered, read
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Message':
+        """Build a message from its API/JSON representation"""
+        return cls(data['id'], data['chatId'], data['senderId'], data['content'], data.get('type', 'text'),
+                   data.get('quotedMessageId'), data.get('timestamp', 0), data.get('status', 'sent'))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the API/JSON representation of the message"""
+        return {
+            'id': self.id,
+            'chatId': self.chat_id,
+            'senderId': self.sender_id,
+            'content': self.content,
+            'type': self.type,
+            'quotedMessageId': self.quoted_message_id,
+            'timestamp': self.timestamp,
+            'status': self.status,
+        }
+
+class MessageStatus:
+    """A user's delivery status for one message"""
+    
+    __slots__ = ('id', 'message_id', 'user_id', 'status', 'timestamp')
+    
+    def __init__(self, id: int, message_id: int, user_id: int, status: str, timestamp: int):
+        """Initialize a message status"""
+        self.id = id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.status = status  # sent, delivered, read
+        self.timestamp = timestamp
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'MessageStatus':
+        """Build a message status from its API/JSON representation"""
+        return cls(data['id'], data['messageId'], data['userId'], data['status'], data.get('timestamp', 0))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the API/JSON representation of the message status"""
+        return {
+            'id': self.id,
+            'messageId': self.message_id,
+            'userId': self.user_id,
+            'status': self.status,
+            'timestamp': self.timestamp,
+        }
+
+class ChatParticipant:
+    """A user's membership of a chat"""
+    
+    __slots__ = ('id', 'chat_id', 'user_id', 'role', 'joined_at')
+    
+    def __init__(self, id: int, chat_id: int, user_id: int, role: str = 'member', joined_at: int = 0):
+        """Initialize a chat participant"""
+        self.id = id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.role = role  # admin, member
+        self.joined_at = joined_at
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ChatParticipant':
+        """Build a chat participant from its API/JSON representation"""
+        return cls(data['id'], data['chatId'], data['userId'], data.get('role', 'member'), data.get('joinedAt', 0))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the API/JSON representation of the chat participant"""
+        return {
+            'id': self.id,
+            'chatId': self.chat_id,
+            'userId': self.user_id,
+            'role': self.role,
+            'joinedAt': self.joined_at,
+        }
\ No newline at end of file
@@ -3,13 +3,14 @@
 import os
 import time
 import json
-from flask import Flask, request, jsonify, session
-import bcrypt
+from flask import Flask, Response, request, jsonify, session, stream_with_context
 from functools import wraps
 from typing import Dict, List, Any, Optional, Callable
 
 # Import our modules
-from openai_service import generate_conversation_starters, ConversationContext
+from db import DEFAULT_MESSAGE_PAGE_SIZE
+from password_hasher import PasswordHasher, PasswordHasherBusy
+from openai_service import StarterGenerator, ConversationContext
 
 def auth_required(f: Callable) -> Callable:
     """Decorator to check if user is authenticated"""
@@ -21,8 +22,22 @@ def auth_required(f: Callable) -> Callable:
         return f(*args, **kwargs)
     return decorated_function
 
-def register_routes(app: Flask, storage, socketio) -> None:
+def password_hasher_busy_response():
+    """Response for a password operation turned away by a saturated hasher"""
+    return jsonify({'message': 'Server is busy, please try again shortly'}), 429, {'Retry-After': '1'}
+
+def register_routes(app: Flask, storage, socketio, registry=None, membership_cache=None, password_hasher=None,
+                    starter_generator=None, starter_prewarmer=None) -> None:
     """Register all routes for the application"""
+    # Authorize through the membership cache when one is available
+    membership = membership_cache or storage
+    
+    # Hash passwords off the request thread
+    hasher = password_hasher or PasswordHasher()
+    
+    # Generate conversation starters off the request thread with a deadline
+    generator = starter_generator or StarterGenerator()
+    max_batch_contacts = int(os.getenv('STARTER_BATCH_MAX_CONTACTS', 100))
     
     @app.route('/api/register', methods=['POST'])
     def register():
@@ -39,7 +54,10 @@ def register_routes(app: Flask, storage, socketio) -> None:
             return jsonify({'message': 'Username already exists'}), 400
         
         # Hash password
-        hashed_password = bcrypt.hashpw(data['password'].encode(), bcrypt.gensalt()).decode()
+        try:
+            hashed_password = hasher.hash(data['password'])
+        except PasswordHasherBusy:
+            return password_hasher_busy_response()
         
         # Create user
         user_data = {
@@ -75,8 +93,18 @@ def register_routes(app: Flask, storage, socketio) -> None:
             return jsonify({'message': 'Invalid username or password'}), 401
         
         # Check password
-        if not bcrypt.checkpw(data['password'].encode(), user['password'].encode()):
-            return jsonify({'message': 'Invalid username or password'}), 401
+        try:
+            if not hasher.verify(data['password'], user['password']):
+                return jsonify({'message': 'Invalid username or password'}), 401
+        except PasswordHasherBusy:
+            return password_hasher_busy_response()
+        
+        # Upgrade the stored hash if the cost factor has changed, skipping it while busy
+        if hasher.needs_rehash(user['password']):
+            try:
+                storage.update_user_password(user['id'], hasher.hash(data['password']))
+            except PasswordHasherBusy:
+                pass
         
         # Set session
         session['user_id'] = user['id']
@@ -227,6 +255,12 @@ def register_routes(app: Flask, storage, socketio) -> None:
         
         try:
             chat = storage.create_chat(chat_data)
+            
+            # Alert participants; their connected sockets already joined the
+            # chat room through the storage membership listener
+            for participant_id in participant_ids:
+                socketio.emit('new_chat', chat, room=f"user_{participant_id}")
+            
             return jsonify(chat), 201
         
         except Exception as e:
@@ -235,16 +269,33 @@ def register_routes(app: Flask, storage, socketio) -> None:
     @app.route('/api/chats/<int:chat_id>/messages', methods=['GET'])
     @auth_required
     def get_messages(chat_id: int):
-        """Get chat messages"""
+        """Get chat messages, optionally paginated with before/after cursors"""
         user_id = session['user_id']
         
         # Check if user is a participant
-        if not storage.is_chat_participant(chat_id, user_id):
+        if not membership.is_chat_participant(chat_id, user_id):
             return jsonify({'message': 'Unauthorized'}), 401
         
+        before = request.args.get('before', type=int)
+        after = request.args.get('after', type=int)
+        limit = request.args.get('limit', type=int)
+        
         try:
-            messages = storage.get_messages_by_chat_id(chat_id)
-            return jsonify(messages), 200
+            # Without pagination parameters return the full history as before
+            if before is None and after is None and limit is None:
+                messages = storage.get_messages_by_chat_id(chat_id)
+                return jsonify(messages), 200
+            
+            page = storage.get_messages_page(
+                chat_id,
+                before=before,
+                after=after,
+                limit=limit or DEFAULT_MESSAGE_PAGE_SIZE
+            )
+            return jsonify(page), 200
+        
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
         
         except Exception as e:
             return jsonify({'message': str(e)}), 500
@@ -263,7 +314,7 @@ def register_routes(app: Flask, storage, socketio) -> None:
         chat_id = data['chatId']
         
         # Check if user is a participant
-        if not storage.is_chat_participant(chat_id, user_id):
+        if not membership.is_chat_participant(chat_id, user_id):
             return jsonify({'message': 'Unauthorized'}), 401
         
         # Create message data
@@ -278,32 +329,17 @@ def register_routes(app: Flask, storage, socketio) -> None:
         }
         
         try:
-            message = storage.create_message(message_data)
-            
-            # Create message status for sender
-            storage.create_message_status({
-                'messageId': message['id'],
-                'userId': user_id,
-                'status': 'sent',
-                'timestamp': int(time.time() * 1000),
-            })
-            
-            # Get all chat participants
-            participants = storage.get_chat_participants(chat_id)
-            
-            # Create message status for other participants
-            for participant in participants:
-                if participant['userId'] != user_id:
-                    storage.create_message_status({
-                        'messageId': message['id'],
-                        'userId': participant['userId'],
-                        'status': 'delivered',
-                        'timestamp': int(time.time() * 1000),
-                    })
+            # Create the message with statuses for all participants in one write
+            participant_ids = storage.get_chat_participant_ids(chat_id)
+            message = storage.create_message_with_statuses(message_data, participant_ids)
             
             # Broadcast message to room
             socketio.emit('message', message, room=f"chat_{chat_id}")
             
+            # Precompute conversation starters once the chat goes quiet
+            if starter_prewarmer:
+                starter_prewarmer.schedule(chat_id)
+            
             return jsonify(message), 201
         
         except Exception as e:
@@ -333,29 +369,87 @@ def register_routes(app: Flask, storage, socketio) -> None:
         # Check if chat exists
         chat = storage.get_chat_by_participants([user_id, contact_id])
         
-        # Get recent messages if chat exists
+        # Get the 5 most recent messages if chat exists
         recent_messages = []
         if chat:
-            # Get all messages for chat
-            all_messages = storage.get_messages_by_chat_id(chat['id'])
-            # Get most recent 5 messages
-            recent_messages = all_messages[-5:] if all_messages else []
+            recent_messages = storage.get_messages_page(chat['id'], limit=5)['messages']
         
         # Create context
-        context = ConversationContext(
-            user=user,
-            contact={
-                'displayName': contact['displayName'],
-                'status': contact_user.get('status', ''),
-                'isScholar': contact.get('isScholar', False),
-            },
-            recent_messages=recent_messages
-        )
+        context = ConversationContext.for_contact(user, contact, contact_user, recent_messages)
+        
+        def push_starters(generated: List[Dict[str, str]]) -> None:
+            """Send starters that missed the deadline to the user's sockets"""
+            socketio.emit('conversation_starters', {
+                'contactId': contact_id,
+                'starters': generated
+            }, room=f"user_{user_id}")
         
         try:
-            # Generate conversation starters
-            starters = generate_conversation_starters(context)
-            return jsonify(starters), 200
+            # Generate conversation starters, answering with defaults if the deadline passes
+            starters, pending = generator.generate(context, on_ready=push_starters)
+            return jsonify(starters), 200, {'X-Starters-Pending': 'true' if pending else 'false'}
         
         except Exception as e:
-            return jsonify({'message': str(e)}), 500
\ No newline at end of file
+            return jsonify({'message': str(e)}), 500
+    
+    @app.route('/api/conversation-starters/batch', methods=['POST'])
+    @auth_required
+    def get_conversation_starters_batch():
+        """Stream conversation starters for several contacts as newline-delimited JSON, each as soon as it is ready"""
+        user_id = session['user_id']
+        data = request.json
+        
+        # Validate request data
+        contact_ids = data.get('contactIds') if data else None
+        if not contact_ids or not isinstance(contact_ids, list) or not all(isinstance(contact_id, int) for contact_id in contact_ids):
+            return jsonify({'message': 'Missing contact IDs'}), 400
+        contact_ids = list(dict.fromkeys(contact_ids))
+        if len(contact_ids) > max_batch_contacts:
+            return jsonify({'message': f'At most {max_batch_contacts} contacts per request'}), 400
+        
+        # Get user
+        user = storage.get_user(user_id)
+        if not user:
+            return jsonify({'message': 'User not found'}), 404
+        
+        # Resolve contacts, chats and recent messages in bulk
+        contacts = {contact['contactId']: contact for contact in storage.get_contacts_by_user_id(user_id)}
+        chat_ids = storage.get_direct_chat_ids(user_id, contact_ids)
+        recent_messages = storage.get_recent_messages_by_chat_ids(list(set(chat_ids.values())), limit=5)
+        
+        contexts = {}
+        missing = []
+        for contact_id in contact_ids:
+            contact = contacts.get(contact_id)
+            if not contact:
+                missing.append(contact_id)
+                continue
+            chat_id = chat_ids.get(contact_id)
+            contexts[contact_id] = ConversationContext.for_contact(
+                user, contact, contact['user'], recent_messages.get(chat_id, []) if chat_id else []
+            )
+        
+        def stream():
+            """Yield one JSON line per contact"""
+            for contact_id in missing:
+                yield json.dumps({'contactId': contact_id, 'message': 'Contact not found'}) + '\n'
+            for contact_id, starters in generator.generate_many(contexts):
+                yield json.dumps({'contactId': contact_id, 'starters': starters}) + '\n'
+        
+        return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+    
+    @app.route('/api/metrics', methods=['GET'])
+    @auth_required
+    def get_metrics():
+        """Get server cache and worker pool metrics"""
+        metrics = {}
+        if membership_cache:
+            metrics['membershipCache'] = membership_cache.stats()
+        metrics['passwordHasher'] = hasher.stats()
+        metrics['starterGenerator'] = generator.stats()
+        if generator.cache:
+            metrics['starterCache'] = generator.cache.stats()
+        if starter_prewarmer:
+            metrics['starterPrewarmer'] = starter_prewarmer.stats()
+        
+        return jsonify(metrics), 200
\ No newline at end of file
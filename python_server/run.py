@@ -1,14 +1,132 @@
 #!/usr/bin/env python3
 """
 Main entry point for the WhatsApp clone Python backend.
+
+Set SERVER_MODE=production to serve with a cooperative async worker
+(SOCKETIO_ASYNC_MODE, gevent by default) instead of the Werkzeug
+development server. The async workers come with the production extra
+(pip install '.[production]'); without it the server warns and falls back
+to threads. SERVER_WORKERS > 1 starts that many worker processes on
+consecutive ports, to sit behind a load balancer with sticky sessions and
+a shared SOCKETIO_MESSAGE_QUEUE; the workers must share MONGODB_URI, since
+in-memory storage only supports a single process.
 """
 import os
+import signal
+import subprocess
+import sys
 from dotenv import load_dotenv
-from app import app, socketio
 
 # Load environment variables
 load_dotenv()
 
+SERVER_MODE = os.getenv('SERVER_MODE', 'development')
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 10))
+
+# Cooperative workers must patch the standard library before the app imports it
+if SERVER_MODE == 'production':
+    os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'gevent')
+    async_mode = os.environ['SOCKETIO_ASYNC_MODE']
+    try:
+        if async_mode == 'eventlet':
+            import eventlet
+            eventlet.monkey_patch()
+        elif async_mode == 'gevent':
+            from gevent import monkey
+            monkey.patch_all()
+    except ImportError:
+        # Serve with threads rather than crash when the production extra isn't installed
+        print(f"Warning: {async_mode} is not installed (pip install '.[production]'), falling back to async mode 'threading'")
+        os.environ['SOCKETIO_ASYNC_MODE'] = 'threading'
+
+def run_workers(count: int, port: int) -> int:
+    """Run worker processes on consecutive ports until they exit, forwarding stop signals"""
+    message_queue = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+    if not message_queue or message_queue.startswith('local://'):
+        print("Warning: SOCKETIO_MESSAGE_QUEUE is not a shared broker, broadcasts will not reach other workers")
+    # In-memory workers would share one data directory and clobber each other's log and snapshots
+    if not os.getenv('MONGODB_URI'):
+        print("Error: SERVER_WORKERS > 1 needs MONGODB_URI, in-memory storage only supports a single worker")
+        return 1
+    
+    workers = []
+    for index in range(count):
+        env = dict(os.environ, PORT=str(port + index), SERVER_WORKER_INDEX=str(index), STORAGE_FALLBACK='false')
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+        print(f"Started worker {index} on port {port + index}")
+    
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signum)
+    
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    return max(worker.wait() for worker in workers)
+
+def run_production(port: int) -> None:
+    """Serve with the configured async worker and shut down gracefully on SIGTERM or SIGINT"""
+    from app import app, socketio, stop_serving, close_resources
+    
+    async_mode = socketio.server.eio.async_mode
+    print(f"Serving on port {port} with async mode '{async_mode}'")
+    
+    # Each server stops accepting first, then drains sockets and in-flight requests
+    if async_mode == 'eventlet':
+        from eventlet import hubs
+        from greenlet import getcurrent
+        main = getcurrent()
+        
+        def stop_server():
+            # Leave the accept loop, after which the server waits for its open connections
+            hubs.get_hub().schedule_call_global(0, main.throw, SystemExit)
+            stop_serving(SHUTDOWN_TIMEOUT)
+    elif async_mode == 'gevent':
+        def stop_server():
+            socketio.wsgi_server.close()
+            stop_serving(SHUTDOWN_TIMEOUT)
+            socketio.wsgi_server.stop(SHUTDOWN_TIMEOUT)
+    else:
+        stop_server = None
+    stop_tasks = []
+    
+    def handle_signal(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print(f"Received signal {signum}, shutting down")
+        if stop_server:
+            stop_tasks.append(socketio.start_background_task(stop_server))
+        else:
+            raise KeyboardInterrupt
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    try:
+        socketio.run(app, host='0.0.0.0', port=port, log_output=False, allow_unsafe_werkzeug=True)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    
+    # The server can return before the stop task has drained every request
+    for task in stop_tasks:
+        task.join()
+    
+    # The threaded server has stopped accepting but its sockets and request threads are still running
+    if not stop_server:
+        stop_serving(SHUTDOWN_TIMEOUT)
+    
+    # Nothing can reach the worker pools or storage once the server has returned
+    close_resources()
+    print("Server stopped")
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5001))
-    socketio.run(app, host='0.0.0.0', port=port, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    workers = int(os.getenv('SERVER_WORKERS', 1))
+    
+    if SERVER_MODE != 'production':
+        from app import app, socketio
+        socketio.run(app, host='0.0.0.0', port=port, debug=True, allow_unsafe_werkzeug=True)
+    elif workers > 1 and 'SERVER_WORKER_INDEX' not in os.environ:
+        sys.exit(run_workers(workers, port))
+    else:
+        run_production(port)
\ No newline at end of file
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Conversation starter cache for the WhatsApp clone application."""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+class StarterCache:
+    """Bounded LRU cache of generated conversation starters with a time to live.
+    
+    Entries are keyed by a fingerprint of everything that shapes the prompt,
+    so a new message or a changed status produces a new key and stale
+    entries simply age out.
+    """
+    
+    def __init__(self, max_size: int = None, ttl: float = None):
+        """Initialize the cache"""
+        self.max_size = max_size or int(os.getenv('STARTER_CACHE_SIZE', 1000))
+        self.ttl = ttl if ttl is not None else float(os.getenv('STARTER_CACHE_TTL', 3600))
+        self._entries = OrderedDict()  # fingerprint -> (expires at, starters)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def fingerprint(context) -> str:
+        """Fingerprint a conversation context from the user, contact and last 5 message IDs"""
+        key = [
+            context.user.get('id'),
+            context.user.get('displayName'),
+            context.contact.get('id'),
+            context.contact.get('displayName'),
+            context.contact.get('status'),
+            bool(context.contact.get('isScholar')),
+            [message.get('id') for message in context.recent_messages[-5:]],
+        ]
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[List[Dict[str, str]]]:
+        """Get cached starters, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            
+            if not entry:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def contains(self, key: str) -> bool:
+        """Check for an unexpired entry without counting a lookup"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+    
+    def put(self, key: str, starters: List[Dict[str, str]]) -> None:
+        """Cache starters, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, starters)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self) -> None:
+        """Drop all cached starters"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache size and hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxSize': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
\ No newline at end of file
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Conversation starter pre-warming for the WhatsApp clone application."""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from openai_service import ConversationContext
+
+class StarterPrewarmer:
+    """Precomputes conversation starters for chats that have gone quiet.
+    
+    Each new message (re)schedules its chat. Once no message has arrived for
+    the quiet period, starters for both participants of a personal chat are
+    generated into the starter cache. The queue of scheduled chats is bounded
+    and each user is pre-warmed at most once per interval.
+    """
+    
+    def __init__(self, storage, generator, quiet_period: float = None, max_queue: int = None,
+                 user_interval: float = None):
+        """Initialize the pre-warmer"""
+        self.storage = storage
+        self.generator = generator
+        self.quiet_period = quiet_period if quiet_period is not None else float(os.getenv('STARTER_PREWARM_QUIET', 10))
+        self.max_queue = max_queue or int(os.getenv('STARTER_PREWARM_QUEUE_SIZE', 1000))
+        self.user_interval = user_interval if user_interval is not None else float(os.getenv('STARTER_PREWARM_USER_INTERVAL', 60))
+        self._due = OrderedDict()  # chatId -> time the chat goes quiet
+        self._last_prewarmed = {}  # userId -> time of the user's last pre-warm
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.rate_limited = 0
+        self.skipped = 0
+        self.prewarmed = 0
+    
+    def schedule(self, chat_id: int, now: Optional[float] = None) -> bool:
+        """Schedule a chat after a new message, returning False if the queue is full"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if chat_id not in self._due and len(self._due) >= self.max_queue:
+                self.dropped += 1
+                return False
+            
+            # Each message restarts the quiet period
+            self._due[chat_id] = now + self.quiet_period
+            self._due.move_to_end(chat_id)
+            return True
+    
+    def run_due(self, now: Optional[float] = None) -> int:
+        """Pre-warm every chat whose quiet period has passed, returning how many users were started"""
+        now = time.monotonic() if now is None else now
+        
+        # Chats are kept in scheduling order, so due chats are at the front
+        chat_ids = []
+        with self._lock:
+            while self._due:
+                chat_id, due = next(iter(self._due.items()))
+                if due > now:
+                    break
+                self._due.popitem(last=False)
+                chat_ids.append(chat_id)
+        
+        started = 0
+        for chat_id in chat_ids:
+            try:
+                started += self._prewarm_chat(chat_id, now)
+            except Exception as e:
+                print(f"Error pre-warming conversation starters for chat {chat_id}: {e}")
+        return started
+    
+    def _prewarm_chat(self, chat_id: int, now: float) -> int:
+        """Start generating starters for both participants of a personal chat"""
+        participant_ids = self.storage.get_chat_participant_ids(chat_id)
+        if len(participant_ids) != 2:
+            return 0
+        
+        recent_messages = self.storage.get_messages_page(chat_id, limit=5)['messages']
+        started = 0
+        for user_id, contact_id in (participant_ids, participant_ids[::-1]):
+            # Limit how often any one user's starters are regenerated
+            with self._lock:
+                if now - self._last_prewarmed.get(user_id, float('-inf')) < self.user_interval:
+                    self.rate_limited += 1
+                    continue
+            
+            context = self._build_context(user_id, contact_id, recent_messages)
+            if not context:
+                continue
+            
+            if not self.generator.prefetch(context):
+                with self._lock:
+                    self.skipped += 1
+                continue
+            
+            with self._lock:
+                self._last_prewarmed[user_id] = now
+                self.prewarmed += 1
+            started += 1
+        
+        return started
+    
+    def _build_context(self, user_id: int, contact_id: int, recent_messages) -> Optional[ConversationContext]:
+        """Build the same context the starters route would, or None if the user lacks the contact"""
+        user = self.storage.get_user(user_id)
+        contact = self.storage.get_contact_by_user_and_contact_id(user_id, contact_id)
+        contact_user = self.storage.get_user(contact_id)
+        if not user or not contact or not contact_user:
+            return None
+        return ConversationContext.for_contact(user, contact, contact_user, recent_messages)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get queue size and pre-warm counters"""
+        with self._lock:
+            return {
+                'queued': len(self._due),
+                'maxQueue': self.max_queue,
+                'prewarmed': self.prewarmed,
+                'rateLimited': self.rate_limited,
+                'skipped': self.skipped,
+                'dropped': self.dropped,
+            }
\ No newline at end of file
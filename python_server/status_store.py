@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Columnar message status store for the WhatsApp clone application."""
+from array import array
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from records import MessageStatus
+
+# Status names by their stored code, where 0 marks a free row
+STATUS_NAMES = (None, 'sent', 'delivered', 'read')
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES) if name}
+READ = STATUS_CODES['read']
+
+# User IDs below this are packed with their message ID into one int key
+PACKED_USER_ID_LIMIT = 1 << 32
+
+class MessageStatusStore(MutableMapping):
+    """Dict-like store of message statuses by ID, kept in parallel arrays.
+    
+    Status IDs are allocated in order, so row N - 1 of each column holds
+    status N and a status costs a few bytes instead of an object. A
+    (message, user) lookup table finds a status without scanning, and a
+    per-message count of read statuses answers "has everyone read this?"
+    without visiting the recipients. Records are only built when a status
+    is returned from storage or persisted.
+    """
+    
+    def __init__(self):
+        """Initialize an empty store"""
+        self._message_ids = array('q')
+        self._user_ids = array('q')
+        self._codes = array('b')
+        self._timestamps = array('q')
+        self._rows: Dict[Any, int] = {}  # (messageId, userId) key, packed when it fits -> status ID
+        self._read_counts = array('l')  # messageId -> statuses marked read
+        self._count = 0
+    
+    def _ensure_row(self, status_id: int) -> int:
+        """Grow the columns to hold a status ID, returning its row"""
+        if status_id < 1:
+            raise KeyError(status_id)
+        row = status_id - 1
+        missing = row + 1 - len(self._codes)
+        if missing > 0:
+            self._message_ids.frombytes(bytes(8 * missing))
+            self._user_ids.frombytes(bytes(8 * missing))
+            self._codes.frombytes(bytes(missing))
+            self._timestamps.frombytes(bytes(8 * missing))
+        return row
+    
+    @staticmethod
+    def _key(message_id: int, user_id: int) -> Any:
+        """Pack a (message, user) pair into one int, which is smaller than a tuple.
+        User IDs too large to pack keep the tuple, which never equals an int key"""
+        if 0 <= user_id < PACKED_USER_ID_LIMIT:
+            return (message_id << 32) | user_id
+        return (message_id, user_id)
+    
+    def _row(self, status_id: int) -> int:
+        """Get the row of an existing status ID"""
+        if not isinstance(status_id, int) or not 0 < status_id <= len(self._codes) or not self._codes[status_id - 1]:
+            raise KeyError(status_id)
+        return status_id - 1
+    
+    def _add_read(self, message_id: int, delta: int) -> None:
+        """Adjust the read count of a message"""
+        missing = message_id + 1 - len(self._read_counts)
+        if missing > 0:
+            self._read_counts.frombytes(bytes(self._read_counts.itemsize * missing))
+        self._read_counts[message_id] += delta
+    
+    def __getitem__(self, status_id: int) -> MessageStatus:
+        """Build the record of a status"""
+        row = self._row(status_id)
+        return MessageStatus(status_id, self._message_ids[row], self._user_ids[row],
+                             STATUS_NAMES[self._codes[row]], self._timestamps[row])
+    
+    def __setitem__(self, status_id: int, status: MessageStatus) -> None:
+        """Add or replace a status from its record"""
+        code = STATUS_CODES.get(status.status)
+        if not code:
+            raise ValueError(f"Unknown message status '{status.status}'")
+        if status_id in self:
+            del self[status_id]
+        
+        row = self._ensure_row(status_id)
+        self._message_ids[row] = status.message_id
+        self._user_ids[row] = status.user_id
+        self._codes[row] = code
+        self._timestamps[row] = status.timestamp
+        self._rows[self._key(status.message_id, status.user_id)] = status_id
+        if code == READ:
+            self._add_read(status.message_id, 1)
+        self._count += 1
+    
+    def __delitem__(self, status_id: int) -> None:
+        """Remove a status"""
+        row = self._row(status_id)
+        message_id = self._message_ids[row]
+        if self._codes[row] == READ:
+            self._add_read(message_id, -1)
+        self._rows.pop(self._key(message_id, self._user_ids[row]), None)
+        self._codes[row] = 0
+        self._count -= 1
+    
+    def __contains__(self, status_id: object) -> bool:
+        """Check if a status ID exists"""
+        try:
+            self._row(status_id)
+        except KeyError:
+            return False
+        return True
+    
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over status IDs"""
+        for row, code in enumerate(self._codes):
+            if code:
+                yield row + 1
+    
+    def __len__(self) -> int:
+        """Count stored statuses"""
+        return self._count
+    
+    def copy(self) -> Dict[int, MessageStatus]:
+        """Build a record of every status, for writing a snapshot"""
+        return {status_id: self[status_id] for status_id in self}
+    
+    def find(self, message_id: int, user_id: int) -> Optional[int]:
+        """Get the status ID of a message for a user"""
+        return self._rows.get(self._key(message_id, user_id))
+    
+    def status_of(self, status_id: int) -> str:
+        """Get the status name of a status ID"""
+        return STATUS_NAMES[self._codes[self._row(status_id)]]
+    
+    def set_status(self, status_id: int, status: str, timestamp: int) -> None:
+        """Change a status in place"""
+        code = STATUS_CODES.get(status)
+        if not code:
+            raise ValueError(f"Unknown message status '{status}'")
+        
+        row = self._row(status_id)
+        old_code = self._codes[row]
+        if old_code != code and READ in (old_code, code):
+            self._add_read(self._message_ids[row], 1 if code == READ else -1)
+        self._codes[row] = code
+        self._timestamps[row] = timestamp
+    
+    def read_count(self, message_id: int) -> int:
+        """Count the statuses of a message that are marked read"""
+        return self._read_counts[message_id] if 0 <= message_id < len(self._read_counts) else 0
+    
+    def iter_rows(self) -> Iterator[Tuple[int, int, int, str]]:
+        """Iterate over (id, messageId, userId, status) without building records"""
+        for row, code in enumerate(self._codes):
+            if code:
+                yield row + 1, self._message_ids[row], self._user_ids[row], STATUS_NAMES[code]
\ No newline at end of file
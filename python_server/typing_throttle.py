@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Server-side throttling of typing indicators for the WhatsApp clone application."""
+import os
+import time
+import threading
+from typing import Dict, List, Optional, Tuple
+
+class TypingState:
+    """Typing indicator state of one user in one chat"""
+    
+    __slots__ = ('broadcast', 'last_broadcast', 'desired', 'last_typing')
+    
+    def __init__(self):
+        """Initialize an idle state"""
+        self.broadcast = False  # State last sent to the room
+        self.last_broadcast = float('-inf')  # When it was sent
+        self.desired = False  # State most recently reported by the client
+        self.last_typing = 0.0  # When the client last reported typing
+
+class TypingThrottle:
+    """Collapses bursts of typing events into rate-limited start/stop transitions.
+    
+    At most one transition per (chat, user) is broadcast per interval; changes
+    arriving sooner are held back and released by flush_due(). A user who
+    stops sending typing events is considered stopped after the expiry time.
+    """
+    
+    def __init__(self, interval: Optional[float] = None, expiry: Optional[float] = None):
+        """Initialize the throttle"""
+        self.interval = interval if interval is not None else float(os.getenv('TYPING_THROTTLE_INTERVAL', 2))
+        self.expiry = expiry if expiry is not None else float(os.getenv('TYPING_EXPIRY', 6))
+        self._states: Dict[Tuple[int, int], TypingState] = {}
+        self._lock = threading.Lock()
+    
+    def update(self, chat_id: int, user_id: int, is_typing: bool, now: Optional[float] = None) -> Optional[bool]:
+        """Record a typing event, returning the state to broadcast now or None"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._states.setdefault((chat_id, user_id), TypingState())
+            state.desired = is_typing
+            if is_typing:
+                state.last_typing = now
+            return self._transition(state, now)
+    
+    def flush_due(self, now: Optional[float] = None) -> List[Tuple[int, int, bool]]:
+        """Release held-back and expired transitions as (chat_id, user_id, is_typing)"""
+        now = time.monotonic() if now is None else now
+        transitions = []
+        with self._lock:
+            for key, state in list(self._states.items()):
+                # Stale typing state expires into a stop
+                if state.desired and now - state.last_typing >= self.expiry:
+                    state.desired = False
+                
+                is_typing = self._transition(state, now)
+                if is_typing is not None:
+                    transitions.append((key[0], key[1], is_typing))
+                
+                # Forget idle users once nothing is pending
+                if not state.broadcast and not state.desired and now - state.last_broadcast >= self.interval:
+                    del self._states[key]
+        
+        return transitions
+    
+    def _transition(self, state: TypingState, now: float) -> Optional[bool]:
+        """Broadcast a pending change if the interval since the last one has passed"""
+        if state.desired == state.broadcast or now - state.last_broadcast < self.interval:
+            return None
+        
+        state.broadcast = state.desired
+        state.last_broadcast = now
+        return state.broadcast